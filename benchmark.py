@@ -0,0 +1,530 @@
+"""Offline benchmarks for the downloader.
+
+Usage::
+
+    python benchmark.py ytdl [--items 100]
+    python benchmark.py startup [--runs 5] [--max-tray-ms 0]
+    python benchmark.py batch [--sizes 10 100 1000] [--latency-ms 20] [--bandwidth 0]
+                              [--error-rate 0] [--mix wb,pinterest,media] [--json FILE]
+
+``ytdl`` compares the per-URL overhead of building a new ``YoutubeDL`` for
+every link (the old behaviour) with the shared :class:`YtdlEngine` of a batch.
+All traffic goes to a local HTTP server, so no network access is needed.
+
+``startup`` launches fresh interpreters and measures the import time of the
+script and the time until the tray icon would start its loop.  With
+``--max-tray-ms`` it exits with status 1 when the median is slower.
+
+``batch`` runs whole batches through ``run_batch`` against :class:`StubSite`,
+which imitates the WB basket hosts, Pinterest pin pages and direct media
+files with configurable latency, bandwidth and errors.  Every batch runs in
+a fresh interpreter and reports wall time, throughput, peak RSS and the
+requests the server saw.  Errors are a function of ``--seed`` and the path,
+so repeated runs see the same failures.
+"""
+
+import argparse
+import dataclasses
+import functools
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from typing import Optional
+
+import yt_dlp
+
+import main_windows_strict as app
+
+# Минимальный «видеофайл»: yt-dlp определяет прямую ссылку по Content-Type
+MEDIA_BODY = b'\x00\x00\x00\x18ftypmp42' + b'\x00' * 4096
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Serves ``/media/<n>.mp4`` as a tiny direct video file."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _headers(self) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(len(MEDIA_BODY)))
+        self.end_headers()
+
+    def do_HEAD(self) -> None:
+        self._headers()
+
+    def do_GET(self) -> None:
+        self._headers()
+        self.wfile.write(MEDIA_BODY)
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address) -> None:
+        # yt-dlp обрывает соединение, прочитав только начало файла
+        pass
+
+
+def start_server(handler) -> ThreadingHTTPServer:
+    server = QuietServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_ytdl(items: int) -> None:
+    server = start_server(MediaHandler)
+    base = f"http://127.0.0.1:{server.server_port}/media"
+    urls = [f"{base}/{i}.mp4" for i in range(items)]
+    opts = {'quiet': True, 'no_warnings': True, 'noprogress': True}
+
+    def before(folder: str) -> None:
+        for url in urls:
+            with yt_dlp.YoutubeDL({**opts, 'outtmpl': os.path.join(folder, '%(id)s.%(ext)s')}) as ydl:
+                ydl.extract_info(url, download=True)
+
+    def after(folder: str) -> None:
+        engine = app.YtdlEngine()
+        try:
+            for url in urls:
+                with engine.acquire({**opts, 'outtmpl': os.path.join(folder, '%(id)s.%(ext)s')}) as ydl:
+                    ydl.extract_info(url, download=True)
+        finally:
+            engine.close()
+
+    results = {}
+    for name, func in (('новый YoutubeDL на ссылку', before), ('общий YtdlEngine', after)):
+        folder = tempfile.mkdtemp(prefix='bench-ytdl-')
+        try:
+            started = time.perf_counter()
+            func(folder)
+            results[name] = time.perf_counter() - started
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    server.shutdown()
+
+    print(f"yt-dlp, {items} ссылок:")
+    for name, elapsed in results.items():
+        print(f"  {name:<28} {elapsed:7.2f} с  ({elapsed / items * 1000:7.1f} мс на ссылку)")
+
+
+# Модули, которые не должны загружаться до появления значка
+HEAVY_MODULES = ('yt_dlp', 'requests', 'asyncio', 'aiohttp', 'bs4', 'PIL.Image')
+
+# Запускается в отдельном интерпретаторе: pystray.Icon.run подменён, поэтому
+# цикл трея не стартует, а горячие клавиши и блокировка экземпляра не трогаются.
+STARTUP_CHILD = r"""
+import json, os, sys, threading, time
+started = time.perf_counter()
+import main_windows_strict as app
+imported = time.perf_counter()
+loaded = [m for m in HEAVY if m in sys.modules]
+
+def run(self, setup=None):
+    tray = time.perf_counter()
+    at_tray = [m for m in HEAVY if m in sys.modules]
+    for t in threading.enumerate():
+        if t.name == 'warm-up':
+            t.join()
+    print(json.dumps({
+        'import': imported - started,
+        'tray': tray - started,
+        'warm': time.perf_counter() - started,
+        'after_import': loaded,
+        'at_tray': at_tray,
+    }), flush=True)
+    os._exit(0)
+
+import pystray
+pystray.Icon.run = run
+app.ensure_single_instance = lambda: None
+app.hotkey_manager.register = lambda combo, callback: None
+app.run_tray()
+"""
+
+
+def bench_startup(runs: int, max_tray_ms: float) -> int:
+    env = dict(os.environ)
+    if not sys.platform.startswith('win') and not env.get('DISPLAY'):
+        env.setdefault('PYSTRAY_BACKEND', 'dummy')
+    child = STARTUP_CHILD.replace('HEAVY', repr(HEAVY_MODULES))
+    samples = []
+    for _ in range(max(1, runs)):
+        started = time.perf_counter()
+        out = subprocess.run(
+            [sys.executable, '-c', child],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        total = time.perf_counter() - started
+        result = json.loads(out.strip().splitlines()[-1])
+        result['process'] = total
+        samples.append(result)
+
+    def median_ms(key: str) -> float:
+        return statistics.median(s[key] for s in samples) * 1000
+
+    print(f"Запуск, медиана из {len(samples)}:")
+    print(f"  импорт скрипта           {median_ms('import'):7.1f} мс")
+    print(f"  до значка в трее         {median_ms('tray'):7.1f} мс")
+    print(f"  с фоновой подготовкой    {median_ms('warm'):7.1f} мс")
+    print(f"  процесс целиком          {median_ms('process'):7.1f} мс (с запуском интерпретатора)")
+    print(f"  загружено после импорта: {', '.join(samples[-1]['after_import']) or '—'}")
+    print(f"  загружено к значку:      {', '.join(samples[-1]['at_tray']) or '—'}")
+    if max_tray_ms and median_ms('tray') > max_tray_ms:
+        print(f"Медленнее порога {max_tray_ms:.0f} мс")
+        return 1
+    return 0
+
+
+# === Пакеты на заглушке ===
+STUB_PHOTOS = (3, 8)
+STUB_IMAGE_SIZE = 24 * 1024
+STUB_PAGE_SIZE = 96 * 1024
+STUB_MEDIA_SIZE = 512 * 1024
+STUB_CHUNK = 16 * 1024
+# Last-Modified всех файлов заглушки
+STUB_MTIME = 1_700_000_000
+# vol -> номер basket-хоста, как растут хосты у WB
+STUB_VOLS_PER_HOST = 40
+
+_BASKET_PATH_RE = re.compile(r'^/basket-(\d+)/vol(\d+)/part\d+/(\d+)/(info/ru/card\.json|images/big/\d+\.webp)$')
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha1(':'.join(map(str, parts)).encode()).hexdigest()
+
+
+@dataclasses.dataclass
+class StubSite:
+    """Behaviour and request counters of the benchmark server."""
+
+    latency: float = 0.0
+    bandwidth: float = 0.0
+    error_rate: float = 0.0
+    seed: int = 1
+    base: str = ''
+    counts: Counter = dataclasses.field(default_factory=Counter)
+    bytes_sent: int = 0
+    _attempts: Counter = dataclasses.field(default_factory=Counter)
+    _lock: threading.Lock = dataclasses.field(default_factory=threading.Lock)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counts.clear()
+            self._attempts.clear()
+            self.bytes_sent = 0
+
+    def count(self, kind: str) -> None:
+        with self._lock:
+            self.counts[kind] += 1
+
+    def sent(self, n: int) -> None:
+        with self._lock:
+            self.bytes_sent += n
+
+    def fails(self, path: str) -> bool:
+        """Whether this attempt at ``path`` gets a 503; depends only on seed, path and attempt."""
+        if not self.error_rate:
+            return False
+        with self._lock:
+            self._attempts[path] += 1
+            attempt = self._attempts[path]
+        return random.Random(_digest(self.seed, path, attempt)).random() < self.error_rate
+
+    @staticmethod
+    def basket(vol: int) -> int:
+        return vol // STUB_VOLS_PER_HOST % app.WB_BASKET_HOSTS
+
+    @staticmethod
+    def photos(product_id: int) -> int:
+        low, high = STUB_PHOTOS
+        return low + int(_digest('photos', product_id), 16) % (high - low + 1)
+
+    def pin_page(self, pin_id: str) -> bytes:
+        h = _digest('pin', pin_id)[:32]
+        path = f"{h[:2]}/{h[2:4]}/{h[4:6]}/{h}.jpg"
+        head = (
+            f'<html><head><meta property="og:image" content="{self.base}/pinimg/736x/{path}">'
+            f'</head><body><script>{{"orig": {{"url": "{self.base}/pinimg/originals/{path}"}}}}'
+        )
+        # Реальные страницы пинов — сотни КБ разметки и JSON
+        filler = ' ' * max(0, STUB_PAGE_SIZE - len(head) - 30)
+        return (head + filler + '</script></body></html>').encode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Routes of :class:`StubSite`: WB baskets, pin pages, pinimg and media files."""
+
+    protocol_version = 'HTTP/1.1'
+    site: StubSite
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _not_modified(self, etag: str) -> bool:
+        if self.headers.get('If-None-Match'):
+            return self.headers['If-None-Match'] == etag
+        since = self.headers.get('If-Modified-Since')
+        try:
+            return bool(since) and parsedate_to_datetime(since).timestamp() >= STUB_MTIME
+        except (TypeError, ValueError):
+            return False
+
+    def _send(self, kind: str, status: int, body: bytes = b'', ctype: str = 'application/octet-stream') -> None:
+        if status == 200:
+            etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+            if self._not_modified(etag):
+                self.site.count('not_modified')
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 200:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', formatdate(STUB_MTIME, usegmt=True))
+        self.end_headers()
+        self.site.count(kind)
+        if self.command == 'HEAD':
+            return
+        view = memoryview(body)
+        # Клиент может закрыть соединение раньше, например дочитав нужное со страницы пина
+        for pos in range(0, len(body), STUB_CHUNK):
+            chunk = view[pos:pos + STUB_CHUNK]
+            self.wfile.write(chunk)
+            self.site.sent(len(chunk))
+            if self.site.bandwidth:
+                time.sleep(len(chunk) / self.site.bandwidth)
+
+    def do_HEAD(self) -> None:
+        self.do_GET()
+
+    def do_GET(self) -> None:
+        site = self.site
+        path = self.path.split('?')[0]
+        if site.latency:
+            time.sleep(site.latency)
+        if site.fails(path):
+            return self._send('error', 503)
+        if m := _BASKET_PATH_RE.match(path):
+            host, vol, product_id = int(m.group(1)), int(m.group(2)), int(m.group(3))
+            if host != site.basket(vol):
+                return self._send('card_miss', 404)
+            if m.group(4).endswith('card.json'):
+                card = {'imt_name': f"Товар {product_id}", 'media': {'photo_count': site.photos(product_id)}}
+                return self._send('card', 200, json.dumps(card).encode(), 'application/json')
+            return self._send('image', 200, _body(path, STUB_IMAGE_SIZE), 'image/webp')
+        if m := re.match(r'^/pin/(\d+)/?$', path):
+            return self._send('page', 200, site.pin_page(m.group(1)), 'text/html; charset=utf-8')
+        if path.startswith('/pinimg/'):
+            return self._send('image', 200, _body(path, STUB_IMAGE_SIZE), 'image/jpeg')
+        if path.startswith('/media/'):
+            return self._send('media', 200, MEDIA_BODY[:16] + _body(path, STUB_MEDIA_SIZE - 16), 'video/mp4')
+        self._send('not_found', 404)
+
+
+@functools.lru_cache(maxsize=4096)
+def _body(path: str, size: int) -> bytes:
+    """Deterministic file contents: the same path always gives the same bytes."""
+    seed = hashlib.sha256(path.encode()).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def stub_urls(base: str, count: int, mix: list[str], seed: int) -> list[str]:
+    """``count`` links spread round-robin over the ``mix`` kinds."""
+    rng = random.Random(seed)
+    makers = {
+        'wb': lambda i: f"{base}/catalog/{rng.randrange(10_000_000, 300_000_000)}/detail.aspx",
+        'pinterest': lambda i: f"{base}/pin/{rng.randrange(10**17, 10**18)}/",
+        'media': lambda i: f"{base}/media/{i}.mp4",
+    }
+    return [makers[mix[i % len(mix)]](i) for i in range(count)]
+
+
+def peak_rss() -> Optional[int]:
+    """Peak resident set size of this process in bytes, if the OS reports it."""
+    try:
+        import resource
+    except ImportError:
+        return _peak_working_set()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _peak_working_set() -> Optional[int]:
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class Counters(ctypes.Structure):
+            _fields_ = [
+                ('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t),
+            ]
+
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except Exception:
+        pass
+    return None
+
+
+def batch_child(base: str, urls_file: str, host_rate: float) -> None:
+    """Run one batch in this interpreter against the stub at ``base``."""
+    folder = tempfile.mkdtemp(prefix='bench-batch-')
+    try:
+        # Настройки, индекс и таблица хостов — свои, чтобы прогоны не влияли друг на друга
+        app.CONFIG_FILE = os.path.join(folder, 'config.ini')
+        with open(app.CONFIG_FILE, 'w', encoding='utf-8') as f:
+            f.write('[youtube]\nprocesses = 0\n')
+        app.download_index = app.DownloadIndex(os.path.join(folder, 'index.sqlite3'))
+        app.basket_resolver = app.BasketResolver(path=os.path.join(folder, 'wb-baskets.json'))
+        app.wb_card_cache = app.WBCardCache(os.path.join(folder, 'wb-cards.sqlite3'))
+        app.metrics.write_status = functools.partial(
+            app.metrics.write_status, os.path.join(folder, 'status.json')
+        )
+        app.http_client.host_rate = host_rate
+        app.WB_BASKET_URL = f"{base}/basket-{{host:02d}}"
+        app.PINIMG_URL = f"{base}/pinimg"
+        app._PINIMG_RE = re.compile(
+            re.escape(base) + r'/pinimg/[^/"\'\s]+/((?:[0-9a-f]{2}/){3}([0-9a-f]+)\.(\w+))'
+        )
+        host = app.urlparse(base).hostname
+        handlers = {h.name: h for h in app.SITE_HANDLERS}
+        for name, path in (('wb', '/catalog/'), ('pinterest', '/pin/'), ('youtube', '/media/')):
+            os.makedirs(os.path.join(folder, name))
+            app.register_handler(dataclasses.replace(
+                handlers[name], hosts=(host,), paths=(path,), folder=os.path.join(folder, name),
+            ))
+
+        with open(urls_file, 'r', encoding='utf-8') as f:
+            urls = f.read().split()
+        started = time.perf_counter()
+        jobs = app.run_batch(urls)
+        wall = time.perf_counter() - started
+        print(json.dumps({
+            'wall': wall,
+            'done': sum(1 for j in jobs if j.status == 'done'),
+            'failed': sum(1 for j in jobs if j.status != 'done'),
+            'bytes': sum(j.size for j in jobs),
+            'peak_rss': peak_rss(),
+        }), flush=True)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_batch(args) -> int:
+    site = StubSite(
+        latency=args.latency_ms / 1000,
+        bandwidth=app.parse_rate(args.bandwidth),
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    handler = type('Handler', (StubHandler,), {'site': site})
+    server = start_server(handler)
+    site.base = f"http://127.0.0.1:{server.server_port}"
+    mix = [k.strip() for k in args.mix.split(',') if k.strip()]
+    results = []
+    try:
+        for size in args.sizes:
+            site.reset()
+            with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False, encoding='utf-8') as f:
+                f.write('\n'.join(stub_urls(site.base, size, mix, args.seed)))
+            try:
+                out = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), 'batch-child',
+                     site.base, f.name, '--host-rate', str(args.host_rate)],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    capture_output=True, text=True, encoding='utf-8', errors='replace',
+                )
+            finally:
+                os.remove(f.name)
+            if out.returncode:
+                print(out.stderr[-2000:], file=sys.stderr)
+                return 1
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            result.update(size=size, requests=dict(site.counts), served=site.bytes_sent)
+            results.append(result)
+    finally:
+        server.shutdown()
+
+    print(
+        f"Пакеты ({', '.join(mix)}; задержка {args.latency_ms:.0f} мс, "
+        f"полоса {args.bandwidth or '∞'}, ошибки {args.error_rate:.0%}, seed {args.seed}):"
+    )
+    print(f"  {'ссылок':>6} {'готово':>7} {'время, с':>9} {'ссылок/с':>9} {'МБ/с':>7} {'пик RSS, МБ':>12}  запросы")
+    for r in results:
+        rss = f"{r['peak_rss'] / 1048576:.0f}" if r['peak_rss'] else '—'
+        requests = ', '.join(f"{k} {v}" for k, v in sorted(r['requests'].items()))
+        print(
+            f"  {r['size']:>6} {r['done']:>7} {r['wall']:>9.2f} {r['size'] / r['wall']:>9.1f} "
+            f"{r['bytes'] / r['wall'] / 1048576:>7.2f} {rss:>12}  {requests}"
+        )
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    ytdl = sub.add_parser('ytdl', help='per-URL overhead of yt-dlp setup')
+    ytdl.add_argument('--items', type=int, default=100)
+    startup = sub.add_parser('startup', help='import time and time-to-tray')
+    startup.add_argument('--runs', type=int, default=5)
+    startup.add_argument('--max-tray-ms', type=float, default=0, help='fail above this median')
+    batch = sub.add_parser('batch', help='end-to-end batches against a stub server')
+    batch.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    batch.add_argument('--mix', default='wb,pinterest,media', help='link kinds, round-robin')
+    batch.add_argument('--latency-ms', type=float, default=20)
+    batch.add_argument('--bandwidth', default='0', help='per response, e.g. 2M; 0 — unlimited')
+    batch.add_argument('--error-rate', type=float, default=0.0, help='share of 503 answers')
+    batch.add_argument('--seed', type=int, default=1)
+    batch.add_argument('--host-rate', type=float, default=0,
+                       help='client requests per second per host; the stub is a single host')
+    batch.add_argument('--json', help='also write the results to this file')
+    child = sub.add_parser('batch-child')
+    child.add_argument('base')
+    child.add_argument('urls_file')
+    child.add_argument('--host-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'ytdl':
+        bench_ytdl(args.items)
+    elif args.command == 'startup':
+        return bench_startup(args.runs, args.max_tray_ms)
+    elif args.command == 'batch':
+        return bench_batch(args)
+    elif args.command == 'batch-child':
+        batch_child(args.base, args.urls_file, args.host_rate)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,17 +3,28 @@ import sys
 import atexit
 import time
 import configparser
+import datetime
 import logging
-from urllib.parse import urlparse
-from typing import Optional
+import json
+import sqlite3
+import math
+import random
+import bisect
+import functools
+import copy
+import hashlib
+import shlex
+import shutil
+import contextvars
+import importlib.util
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, wait as futures_wait
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+from typing import TYPE_CHECKING, Callable, Optional
 import re
 
-import yt_dlp
-import requests
-from bs4 import BeautifulSoup
-import keyboard
-import pystray
-import pyperclip
 import threading
 try:
     import win32con
@@ -26,8 +37,25 @@ except Exception:
 # Simple URL validation pattern used when grabbing the clipboard
 URL_RE = re.compile(r'^https?://\S+$', re.IGNORECASE)
 
-from PIL import Image
 import subprocess
+import signal
+import argparse
+
+# Модули интерфейса (трей, горячие клавиши, буфер обмена) загружаются только
+# при запуске в режиме трея — в headless-режиме они не нужны. yt_dlp
+# импортируется при первой ссылке YouTube, requests и asyncio — при первом
+# HTTP-запросе, так что значок в трее появляется, не дожидаясь загрузчиков.
+if TYPE_CHECKING:
+    import asyncio
+    import multiprocessing
+    from http.server import ThreadingHTTPServer
+    from multiprocessing.connection import Connection
+
+    import aiohttp
+    import pystray
+    import requests
+    import yt_dlp
+    from PIL import Image
 
 
 class HotkeyManager:
@@ -95,6 +123,7 @@ class HotkeyManager:
                 except Exception as e:
                     logging.error('Win32 hotkey failed: %s', e)
         logging.info('Registering hotkey via keyboard library: %s', combo)
+        import keyboard
         keyboard.add_hotkey(combo, callback, suppress=True, trigger_on_release=True)
 
     def unregister_all(self) -> None:
@@ -105,7 +134,8 @@ class HotkeyManager:
                 except Exception:
                     pass
             self.ids.clear()
-        keyboard.unhook_all_hotkeys()
+        if 'keyboard' in sys.modules:
+            sys.modules['keyboard'].unhook_all_hotkeys()
 
     def start_listener(self) -> None:
         """Keyboard-based implementation has no dedicated listener."""
@@ -126,13 +156,20 @@ def read_clipboard() -> str:
         for _ in range(3):
             try:
                 win32clipboard.OpenClipboard()
-                text = win32clipboard.GetClipboardData(win32con.CF_UNICODETEXT)
-                win32clipboard.CloseClipboard()
-                break
             except Exception:
+                # Буфер ещё держит приложение, из которого копировали
                 time.sleep(0.05)
+                continue
+            try:
+                text = win32clipboard.GetClipboardData(win32con.CF_UNICODETEXT)
+            except Exception:
+                text = ""
+            finally:
+                win32clipboard.CloseClipboard()
+            break
     if not text:
         try:
+            import pyperclip
             text = pyperclip.paste()
         except Exception as e:
             logging.error("Pyperclip error: %s", e)
@@ -168,6 +205,12 @@ DOWNLOAD_LIST = os.path.join(SYSTEM_DIR, 'download-list.txt')
 CONFIG_FILE = os.path.join(SYSTEM_DIR, 'config.ini')
 LOG_FILE = os.path.join(SYSTEM_DIR, 'script.log')
 INFO_FILE = os.path.join(SYSTEM_DIR, 'info.txt')
+WB_BASKETS_FILE = os.path.join(SYSTEM_DIR, 'wb-baskets.json')
+WB_CARDS_FILE = os.path.join(SYSTEM_DIR, 'wb-cards.sqlite3')
+JOURNAL_FILE = os.path.join(SYSTEM_DIR, 'jobs.sqlite3')
+INDEX_FILE = os.path.join(SYSTEM_DIR, 'index.sqlite3')
+STATUS_FILE = os.path.join(SYSTEM_DIR, 'status.json')
+YTDL_CACHE_DIR = os.path.join(SYSTEM_DIR, 'yt-dlp-cache')
 
 # Ensure the system directory exists before configuring logging
 os.makedirs(SYSTEM_DIR, exist_ok=True)
@@ -191,18 +234,32 @@ downloading = threading.Event()
 
 # Изображения для разных состояний значка
 
-def load_icon(name: str) -> Optional[Image.Image]:
+ICON_FILES = {
+    'default': os.path.join('icons', 'ico.ico'),
+    'active': os.path.join('icons', 'act.ico'),
+    'downloading': os.path.join('icons', 'dw.ico'),
+}
+_icon_cache: dict[str, Optional['Image.Image']] = {}
+
+
+def load_icon(name: str) -> Optional['Image.Image']:
     """Load an icon image, returning ``None`` on failure."""
     try:
+        from PIL import Image
         return Image.open(resource_path(name))
     except Exception:
         return None
 
-ICON_DEFAULT = load_icon(os.path.join('icons', 'ico.ico'))
-ICON_ACTIVE = load_icon(os.path.join('icons', 'act.ico'))
-ICON_DOWNLOADING = load_icon(os.path.join('icons', 'dw.ico'))
 
-def flash_tray_icon(icon: pystray.Icon, image: Image.Image, duration: float = 0.3) -> None:
+def tray_image(state: str) -> Optional['Image.Image']:
+    """Return the icon for ``state`` (see :data:`ICON_FILES`), loading it once."""
+    if state not in _icon_cache:
+        _icon_cache[state] = load_icon(ICON_FILES[state])
+    return _icon_cache[state]
+
+def flash_tray_icon(
+    icon: 'pystray.Icon', image: Optional['Image.Image'], duration: float = 0.3
+) -> None:
     """Temporarily change the tray icon."""
     if not icon or not image:
         return
@@ -221,6 +278,8 @@ def flash_tray_icon(icon: pystray.Icon, image: Image.Image, duration: float = 0.
     threading.Timer(duration, restore).start()
 
 
+TRAY_TITLE = 'YT Downloader'
+
 DEFAULT_CONFIG = {
     'add_hotkey': 'ctrl+space',
     'download_hotkey': 'ctrl+shift+space',
@@ -246,8 +305,44 @@ def load_config() -> dict:
     return DEFAULT_CONFIG.copy()
 
 
+def load_section(name: str, defaults: dict) -> dict:
+    """Return section ``[name]`` of config.ini over ``defaults``.
+
+    Values are converted to the type of the corresponding default; unknown
+    or malformed values fall back to the default.
+    """
+    result = dict(defaults)
+    parser = configparser.ConfigParser()
+    try:
+        parser.read(CONFIG_FILE, encoding='utf-8')
+    except Exception as e:
+        logging.error('Ошибка загрузки конфигурации: %s', e)
+        return result
+    if not parser.has_section(name):
+        return result
+    for key, value in parser.items(name):
+        default = defaults.get(key)
+        try:
+            if isinstance(default, bool):
+                result[key] = parser.getboolean(name, key)
+            elif isinstance(default, int):
+                result[key] = int(value)
+            elif isinstance(default, float):
+                result[key] = float(value)
+            else:
+                result[key] = value
+        except ValueError:
+            logging.error('Неверное значение %s.%s = %r', name, key, value)
+    return result
+
+
 def save_config(cfg: dict) -> None:
     parser = configparser.ConfigParser()
+    # Остальные секции (метрики, скорость и т.п.) сохраняем как есть
+    try:
+        parser.read(CONFIG_FILE, encoding='utf-8')
+    except Exception as e:
+        logging.error('Ошибка загрузки конфигурации: %s', e)
     parser['hotkeys'] = {
         'add_hotkey': cfg.get('add_hotkey', DEFAULT_CONFIG['add_hotkey']),
         'download_hotkey': cfg.get('download_hotkey', DEFAULT_CONFIG['download_hotkey'])
@@ -259,382 +354,4261 @@ def save_config(cfg: dict) -> None:
         logging.error('Ошибка сохранения конфигурации: %s', e)
 
 
+def atomic_write_text(path: str, text: str) -> None:
+    """Write ``text`` to ``path`` via a temporary file and ``os.replace``."""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
 def ensure_single_instance() -> None:
-    """Предотвращает запуск нескольких экземпляров скрипта."""
-    if sys.platform.startswith('win'):
-        import msvcrt
-        lock_path = os.path.join(SYSTEM_DIR, 'script.lock')
-        lock_file = open(lock_path, 'w')
-        try:
+    """Предотвращает запуск нескольких экземпляров скрипта.
+
+    Uses ``msvcrt.locking`` on Windows and ``fcntl.flock`` elsewhere; the lock
+    is released by the OS if the process dies.
+    """
+    lock_path = os.path.join(SYSTEM_DIR, 'script.lock')
+    lock_file = open(lock_path, 'w')
+    try:
+        if sys.platform.startswith('win'):
+            import msvcrt
             msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
-        except OSError:
-            logging.info('Попытка запуска второго экземпляра.')
-            print('Скрипт уже запущен.')
-            sys.exit(0)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        logging.info('Попытка запуска второго экземпляра.')
+        print('Скрипт уже запущен.')
+        sys.exit(0)
 
-        def release_lock() -> None:
-            try:
+    def release_lock() -> None:
+        try:
+            if sys.platform.startswith('win'):
+                import msvcrt
                 msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
                 lock_file.close()
                 os.remove(lock_path)
-            except Exception:
-                pass
-            logging.info('Lock file released.')
+            else:
+                import fcntl
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                lock_file.close()
+        except Exception:
+            pass
+        logging.info('Lock file released.')
 
-        atexit.register(release_lock)
+    atexit.register(release_lock)
 
 
-def download_video(url, folder):
-    ydl_opts = {
-        'format': 'best',
-        'outtmpl': os.path.join(folder, '%(title)s.%(ext)s'),
-        'merge_output_format': 'mp4',
-        'quiet': False,
-        'no_warnings': True,
-    }
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-    except Exception as e:
-        logging.error('Ошибка при скачивании YouTube-содержимого: %s', e)
-        print(f"Ошибка при скачивании YouTube-содержимого: {e}")
+# === Метрики ===
+METRICS_DEFAULTS = {
+    # 0 — HTTP-эндпоинт отключён; иначе слушает 127.0.0.1:<port>
+    'http_port': 0,
+    'status_interval': 1.0,
+}
+# Окно, по которому считается текущая скорость, секунды
+SPEED_WINDOW = 5.0
 
 
-def download_playlist(url, folder):
-    ydl_opts = {
-        'format': 'best',
-        'outtmpl': os.path.join(folder, '%(title)s.%(ext)s'),
-        'merge_output_format': 'mp4',
-        'quiet': False,
-        'no_warnings': True,
-        'yes_playlist': True,
-    }
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-    except Exception as e:
-        logging.error('Ошибка при скачивании плейлиста: %s', e)
-        print(f"Ошибка при скачивании плейлиста: {e}")
+class JobMetrics:
+    """Counters of one running or finished job."""
 
+    def __init__(self, url: str, site: str) -> None:
+        self.url = url
+        self.site = site
+        self.status = 'running'
+        self.bytes = 0
+        self.retries = 0
+        self.eta: Optional[float] = None
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.ytdl_seen: dict[str, int] = {}
 
-def download_pinterest_image(url, folder):
-    try:
-        response = requests.get(url, headers={"User-Agent": "Mozilla/5.0"})
-        soup = BeautifulSoup(response.text, 'html.parser')
-        img_tag = soup.find('img')
-        if img_tag and img_tag.get('src'):
-            img_url = img_tag['src']
-            print(f"Скачиваем изображение: {img_url}")
-            img_data = requests.get(img_url).content
-            filename = os.path.join(folder, os.path.basename(img_url.split("?")[0]))
-            with open(filename, 'wb') as f:
-                f.write(img_data)
-            print(f"Изображение сохранено как: {filename}")
-        else:
-            print("Не удалось найти изображение на странице Pinterest.")
-    except Exception as e:
-        logging.error('Ошибка при скачивании изображения с Pinterest: %s', e)
-        print(f"Ошибка при скачивании изображения с Pinterest: {e}")
+    @property
+    def duration(self) -> float:
+        return (self.finished or time.time()) - self.started
 
+    def as_dict(self) -> dict:
+        duration = self.duration
+        return {
+            'url': self.url,
+            'site': self.site,
+            'status': self.status,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'duration': round(duration, 3),
+            'speed': round(self.bytes / duration, 1) if duration > 0 else 0.0,
+            'eta': self.eta,
+        }
 
-def download_wb_images(url: str, folder: str) -> None:
-    """Скачивает все изображения товара Wildberries."""
-    try:
-        m = re.search(r"/catalog/(\d+)/", url)
-        if not m:
-            print("Не удалось извлечь ID товара из ссылки WB.")
-            return
-        product_id = m.group(1)
 
-        vol = int(product_id) // 100000
-        part = int(product_id) // 1000
+_current_job: contextvars.ContextVar[Optional[JobMetrics]] = contextvars.ContextVar(
+    'current_job', default=None
+)
 
-        headers = {"User-Agent": "Mozilla/5.0"}
 
-        card_data = None
-        host_used = None
-        for host in range(100):
-            card_url = (
-                f"https://basket-{host:02d}.wbbasket.ru/vol{vol}/part{part}/"
-                f"{product_id}/info/ru/card.json"
-            )
-            try:
-                resp = requests.get(card_url, headers=headers, timeout=5)
-                if resp.status_code == 200:
-                    card_data = resp.json()
-                    host_used = host
-                    break
-            except Exception:
-                continue
+def submit_with_context(pool: ThreadPoolExecutor, fn: Callable, *args):
+    """``pool.submit`` that keeps the caller's job context for metrics."""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
 
-        if not card_data:
-            print("Не удалось получить данные о товаре WB.")
-            return
 
-        name = card_data.get("imt_name", f"wb_{product_id}")
-        safe_name = "".join(c for c in name if c not in "\\/:*?\"<>|")
-        product_folder = os.path.join(folder, safe_name)
-        os.makedirs(product_folder, exist_ok=True)
+class Metrics:
+    """Process-wide download metrics.
 
-        count = card_data.get("media", {}).get("photo_count") or 0
-        if not count:
-            print("Не удалось определить количество изображений WB.")
-            return
+    The scheduler opens a :class:`JobMetrics` per job and binds it to the
+    worker's context; the HTTP client and yt-dlp progress hooks then add
+    bytes and retries to whatever job is current.  Site totals are
+    cumulative (Prometheus counters), the ``batch`` part restarts with every
+    batch.
+    """
 
-        host_part = f"https://basket-{host_used:02d}.wbbasket.ru"
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.sites: dict[str, dict[str, float]] = defaultdict(
+            lambda: {'bytes': 0, 'done': 0, 'failed': 0, 'retries': 0, 'seconds': 0.0}
+        )
+        self.active: dict[int, JobMetrics] = {}
+        self.finished: deque[JobMetrics] = deque(maxlen=200)
+        self.queue_depth = 0
+        self.batch_started: Optional[float] = None
+        self.batch_bytes = 0
+        self.batch_done = 0
+        self.batch_failed = 0
+        # Выбор форматов yt-dlp за пакет: оценка выбранного и того, что дал бы 'best'
+        self.formats = {'videos': 0, 'compared': 0, 'chosen_bytes': 0.0, 'best_bytes': 0.0}
+        # Обработка картинок за пакет (см. ImageProcessor)
+        self.images = {'processed': 0, 'files': 0, 'failed': 0}
+        self._window: deque[tuple[float, int]] = deque()
 
-        for i in range(1, count + 1):
-            img_url = (
-                f"{host_part}/vol{vol}/part{part}/{product_id}/images/big/{i}.webp"
-            )
-            try:
-                img_data = requests.get(img_url, headers=headers, timeout=10).content
-                out_path = os.path.join(product_folder, f"{i}.webp")
-                with open(out_path, "wb") as f:
-                    f.write(img_data)
-                print(f"Скачано: {out_path}")
-            except Exception as e:
-                logging.error("Не удалось скачать %s: %s", img_url, e)
-    except Exception as e:
-        logging.error("Ошибка при скачивании изображений WB: %s", e)
-        print(f"Ошибка при скачивании изображений WB: {e}")
+    def start_batch(self) -> None:
+        with self._lock:
+            self.batch_started = time.time()
+            self.batch_bytes = self.batch_done = self.batch_failed = 0
+            self.formats = dict.fromkeys(self.formats, 0)
+            self.images = dict.fromkeys(self.images, 0)
+            self.finished.clear()
+
+    def end_batch(self) -> None:
+        with self._lock:
+            self.batch_started = None
+
+    def job_started(self, job: 'DownloadJob') -> JobMetrics:
+        jm = JobMetrics(job.url, job.site)
+        with self._lock:
+            self.active[id(job)] = jm
+        _current_job.set(jm)
+        return jm
 
+    def job_finished(self, job: 'DownloadJob') -> None:
+        with self._lock:
+            jm = self.active.pop(id(job), None)
+            if jm is None:
+                return
+            jm.status = 'cached' if job.cached else job.status
+            jm.finished = time.time()
+            site = self.sites[jm.site]
+            site['seconds'] += jm.duration
+            if job.status == 'done':
+                site['done'] += 1
+                self.batch_done += 1
+            else:
+                site['failed'] += 1
+                self.batch_failed += 1
+            self.finished.append(jm)
+        _current_job.set(None)
 
-def handle_url(url: str) -> None:
-    """Определяет тип ссылки и запускает скачивание."""
-    hostname = urlparse(url).hostname or ""
-    hostname = hostname.lower()
+    def add_bytes(self, n: int) -> None:
+        jm = _current_job.get()
+        now = time.monotonic()
+        with self._lock:
+            self._window.append((now, n))
+            self.batch_bytes += n
+            if jm is not None:
+                jm.bytes += n
+                self.sites[jm.site]['bytes'] += n
 
-    if "youtube.com/playlist" in url:
-        logging.info('Скачиваем плейлист: %s', url)
-        print(f"Это плейлист YouTube. Скачиваем всё в: {PLAYLIST_FOLDER}")
-        download_playlist(url, PLAYLIST_FOLDER)
+    def add_retry(self) -> None:
+        jm = _current_job.get()
+        if jm is None:
+            return
+        with self._lock:
+            jm.retries += 1
+            self.sites[jm.site]['retries'] += 1
 
-    elif "youtube.com" in hostname or "youtu.be" in hostname:
-        logging.info('Скачиваем видео: %s', url)
-        print(f"Это видео YouTube. Скачиваем в: {VIDEOS_FOLDER}")
-        download_video(url, VIDEOS_FOLDER)
+    def add_formats(self, chosen: Optional[float], best: Optional[float]) -> None:
+        """Record the estimated size of a format choice and of ``'best'`` for it."""
+        with self._lock:
+            self.formats['videos'] += 1
+            if chosen and best:
+                self.formats['compared'] += 1
+                self.formats['chosen_bytes'] += chosen
+                self.formats['best_bytes'] += best
 
-    elif "pinterest.com" in hostname:
-        logging.info('Скачиваем изображение Pinterest: %s', url)
-        print("Это Pinterest ссылка. Пытаемся скачать...")
-        download_pinterest_image(url, PICTURES_FOLDER)
+    def format_savings(self) -> Optional[str]:
+        """One-line summary of :meth:`add_formats` for the batch report."""
+        with self._lock:
+            f = dict(self.formats)
+        if not f['compared']:
+            return None
+        saved = f['best_bytes'] - f['chosen_bytes']
+        return (
+            f"Форматы: {f['chosen_bytes'] / 1048576:.1f} МБ вместо {f['best_bytes'] / 1048576:.1f} МБ "
+            f"при 'best' ({'экономия' if saved >= 0 else 'больше на'} {abs(saved) / 1048576:.1f} МБ, "
+            f"сравнено видео: {f['compared']} из {f['videos']})"
+        )
 
-    elif "wildberries.ru" in hostname:
-        logging.info('Скачиваем товар Wildberries: %s', url)
-        print("Это ссылка Wildberries. Пытаемся скачать изображения...")
-        download_wb_images(url, WB_FOLDER)
+    def add_image(self, files: Optional[int]) -> None:
+        """Record a processed image and the files written for it; ``None`` is a failure."""
+        with self._lock:
+            if files is None:
+                self.images['failed'] += 1
+            else:
+                self.images['processed'] += 1
+                self.images['files'] += files
 
-    else:
-        logging.warning('Неизвестная ссылка: %s', url)
-        print("Сайт не поддерживается этим скриптом.")
+    def image_summary(self) -> Optional[str]:
+        """One-line summary of :meth:`add_image` for the batch report."""
+        with self._lock:
+            i = dict(self.images)
+        if not i['processed'] and not i['failed']:
+            return None
+        return f"Картинки: обработано {i['processed']}, записано файлов {i['files']}, ошибок {i['failed']}"
 
+    def ytdl_hook(self, d: dict) -> None:
+        """yt-dlp ``progress_hooks`` entry: turns cumulative byte counts into deltas."""
+        if d.get('status') == 'formats':
+            self.add_formats(d.get('chosen_bytes'), d.get('best_bytes'))
+            return
+        jm = _current_job.get()
+        if jm is None or d.get('status') not in ('downloading', 'finished'):
+            return
+        name = d.get('filename') or ''
+        total = d.get('downloaded_bytes') or 0
+        delta = total - jm.ytdl_seen.get(name, 0)
+        jm.ytdl_seen[name] = total
+        jm.eta = d.get('eta')
+        if delta > 0:
+            transferred(delta)
 
-def download_all(icon: Optional[pystray.Icon] = None) -> None:
-    """Скачивает все ссылки из файла download-list.txt в отдельном потоке."""
-    if downloading.is_set():
-        print("Скачивание уже выполняется.")
-        return
+    def speed(self) -> float:
+        """Aggregate bytes per second over the last :data:`SPEED_WINDOW` seconds."""
+        now = time.monotonic()
+        with self._lock:
+            while self._window and self._window[0][0] < now - SPEED_WINDOW:
+                self._window.popleft()
+            return sum(n for _, n in self._window) / SPEED_WINDOW
 
-    # —————— Смена иконки на dw.ico ——————
-    if icon is not None and ICON_DOWNLOADING:
+    def snapshot(self) -> dict:
+        speed = self.speed()
+        with self._lock:
+            return {
+                'time': time.time(),
+                'speed': round(speed, 1),
+                'queue_depth': self.queue_depth,
+                'batch': {
+                    'running': self.batch_started is not None,
+                    'started': self.batch_started,
+                    'bytes': self.batch_bytes,
+                    'done': self.batch_done,
+                    'failed': self.batch_failed,
+                    'formats': dict(self.formats),
+                    'images': dict(self.images),
+                },
+                'active': [jm.as_dict() for jm in self.active.values()],
+                'finished': [jm.as_dict() for jm in self.finished],
+                'sites': {name: dict(v) for name, v in self.sites.items()},
+                'http': http_client.stats(),
+            }
+
+    def prometheus(self) -> str:
+        """Render the counters in the Prometheus text exposition format."""
+        snap = self.snapshot()
+        lines = [
+            '# TYPE downloader_speed_bytes gauge',
+            f"downloader_speed_bytes {snap['speed']}",
+            '# TYPE downloader_queue_depth gauge',
+            f"downloader_queue_depth {snap['queue_depth']}",
+            '# TYPE downloader_active_jobs gauge',
+            f"downloader_active_jobs {len(snap['active'])}",
+        ]
+        for metric, key in (
+            ('downloader_site_bytes_total', 'bytes'),
+            ('downloader_site_jobs_done_total', 'done'),
+            ('downloader_site_jobs_failed_total', 'failed'),
+            ('downloader_site_retries_total', 'retries'),
+            ('downloader_site_seconds_total', 'seconds'),
+        ):
+            lines.append(f'# TYPE {metric} counter')
+            for site, values in sorted(snap['sites'].items()):
+                lines.append(f'{metric}{{site="{site}"}} {values[key]}')
+        lines.append('# TYPE downloader_http_requests_total counter')
+        for host, st in sorted(snap['http'].items()):
+            lines.append(f'downloader_http_requests_total{{host="{host}"}} {st["requests"]}')
+        lines.append('# TYPE downloader_http_latency_seconds histogram')
+        for host, st in sorted(snap['http'].items()):
+            cumulative = 0
+            for le, n in st['latency'].items():
+                cumulative += n
+                lines.append(
+                    f'downloader_http_latency_seconds_bucket{{host="{host}",le="{le}"}} {cumulative}'
+                )
+            lines.append(f'downloader_http_latency_seconds_sum{{host="{host}"}} {st["latency_sum"]}')
+            lines.append(f'downloader_http_latency_seconds_count{{host="{host}"}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def tooltip(self) -> str:
+        speed = self.speed()
+        with self._lock:
+            active, queued = len(self.active), self.queue_depth
+        return f"{speed / 1048576:.2f} МБ/с, активно {active}, в очереди {queued}"
+
+    def write_status(self, path: str = STATUS_FILE) -> None:
         try:
-            icon.icon = ICON_DOWNLOADING
-        except Exception:
+            atomic_write_text(path, json.dumps(self.snapshot(), ensure_ascii=False, indent=1))
+        except Exception as e:
+            logging.error('Не удалось записать %s: %s', path, e)
+
+
+metrics = Metrics()
+
+
+def start_metrics_server(port: Optional[int] = None) -> Optional['ThreadingHTTPServer']:
+    """Serve ``/metrics`` and ``/status`` on localhost if ``[metrics] http_port`` is set."""
+    if port is None:
+        port = load_section('metrics', METRICS_DEFAULTS)['http_port']
+    if not port:
+        return None
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:
             pass
 
-    def worker() -> None:
-        try:
-            if not os.path.exists(DOWNLOAD_LIST):
-                print("Файл download-list.txt не найден.")
+        def do_GET(self) -> None:
+            if self.path.startswith('/metrics'):
+                body = metrics.prometheus().encode('utf-8')
+                ctype = 'text/plain; version=0.0.4'
+            elif self.path.startswith('/status'):
+                body = json.dumps(metrics.snapshot(), ensure_ascii=False).encode('utf-8')
+                ctype = 'application/json'
+            else:
+                self.send_error(404)
                 return
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    try:
+        server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    except OSError as e:
+        logging.error('Не удалось открыть порт метрик %s: %s', port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info('Метрики доступны на http://127.0.0.1:%s/metrics', port)
+    return server
 
-            with open(DOWNLOAD_LIST, 'r', encoding='utf-8') as f:
-                urls = [line.strip() for line in f if line.strip()]
 
-            if not urls:
-                print("Список ссылок пуст.")
-                return
+# === Ограничение скорости ===
+# Ставки — байты в секунду; в config.ini можно писать 500K, 2M, 1.5G
+BANDWIDTH_KEYS = ('limit', 'youtube', 'wb', 'pinterest', 'other')
+# Плейлисты делят полосу с обычными видео
+BANDWIDTH_SITE_ALIASES = {'playlist': 'youtube'}
+# Как часто перечитывать config.ini (смена профиля по времени суток)
+BANDWIDTH_REFRESH = 60.0
+_WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
 
-            for url in urls:
-                handle_url(url)
 
-            open(DOWNLOAD_LIST, 'w', encoding='utf-8').close()
-            print("Скачивание завершено!")
-            if icon is not None:
-                try:
-                    icon.notify('Complete', 'Скачивание завершено')
-                except Exception:
-                    pass
+def parse_rate(text: str) -> float:
+    """Parse ``'2M'``, ``'500k'`` or ``'1048576'`` into bytes per second."""
+    text = text.strip().lower().rstrip('b/s').strip()
+    if not text:
+        return 0.0
+    factor = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}.get(text[-1], 1)
+    if factor != 1:
+        text = text[:-1]
+    return float(text) * factor
 
-        finally:
-            downloading.clear()
-            # —————— Возврат иконки ico.ico ——————
-            if icon is not None and ICON_DEFAULT:
-                try:
-                    icon.icon = ICON_DEFAULT
-                except Exception:
-                    pass
 
-    downloading.set()
-    threading.Thread(target=worker, daemon=True).start()
+def _in_hours(spec: str, now: datetime.datetime) -> bool:
+    """``'09:00-18:00'``; ranges crossing midnight (``'22:00-07:00'``) work too."""
+    start, end = (datetime.time.fromisoformat(p.strip()) for p in spec.split('-', 1))
+    t = now.time()
+    return start <= t < end if start <= end else t >= start or t < end
 
 
+def _in_days(spec: str, now: datetime.datetime) -> bool:
+    """``'mon-fri'``, ``'sat,sun'``; an empty spec matches every day."""
+    today = now.weekday()
+    for part in filter(None, (p.strip().lower() for p in spec.split(','))):
+        first, _, last = part.partition('-')
+        lo = _WEEKDAYS.index(first[:3])
+        hi = _WEEKDAYS.index(last[:3]) if last else lo
+        if lo <= today <= hi if lo <= hi else today >= lo or today <= hi:
+            return True
+    return not spec.strip()
 
-def add_link_from_clipboard() -> None:
-    """Copy the current selection and append it to ``download-list.txt``."""
 
-    logging.info('Hotkey triggered: copying selection')
+class TokenBucket:
+    """Token bucket that lets callers run into debt and then sleep it off.
 
-    keyboard.press_and_release("ctrl+c")
-    time.sleep(0.3)
-    text = ""
-    try:
-        if win32clipboard:
-            try:
-                win32clipboard.OpenClipboard()
-                text = win32clipboard.GetClipboardData(win32con.CF_UNICODETEXT)
-            finally:
-                win32clipboard.CloseClipboard()
-        if not text:
-            text = pyperclip.paste()
-    except Exception as e:
-        logging.error("Clipboard read error: %s", e)
-    url = text.strip()
+    ``reserve`` only computes the delay, so the caller sleeps without holding
+    the lock (or awaits it in an event loop); one second of traffic may be
+    sent as a burst.
+    """
 
-    if not url:
-        logging.info('Clipboard capture failed or empty')
-        print("Не удалось скопировать ссылку. Возможно, она не выделена.")
-        return
+    def __init__(self, rate: float = 0.0) -> None:
+        self._lock = threading.Lock()
+        self.rate = rate
+        self._tokens = rate
+        self._stamp = time.monotonic()
 
-    if not URL_RE.match(url):
-        logging.info('Clipboard text not a valid URL: %s', url)
-        print("Скопированный текст не похож на ссылку.")
-        return
+    def set_rate(self, rate: float) -> None:
+        with self._lock:
+            if rate != self.rate:
+                self.rate = rate
+                self._tokens = min(self._tokens, rate)
 
-    existing = []
-    if os.path.exists(DOWNLOAD_LIST):
-        with open(DOWNLOAD_LIST, 'r', encoding='utf-8') as f:
-            existing = [line.strip() for line in f if line.strip()]
+    def reserve(self, n: int) -> float:
+        """Take ``n`` tokens and return how long the caller should sleep."""
+        with self._lock:
+            if self.rate <= 0:
+                return 0.0
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= n
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
 
-    if url in existing:
-        logging.info('Дубликат ссылки: %s', url)
-        print('Ссылка уже присутствует в списке.')
-        return
 
-    with open(DOWNLOAD_LIST, 'a', encoding='utf-8') as f:
-        f.write(url + '\n')
-    confirm = False
-    try:
-        with open(DOWNLOAD_LIST, 'r', encoding='utf-8') as f:
-            confirm = url in [line.strip() for line in f if line.strip()]
-    except Exception:
-        pass
-    if confirm:
-        logging.info('Link added: %s', url)
-        print(f"Добавлено в список: {url}")
-    else:
-        logging.error('Failed to confirm link save: %s', url)
-        print("Не удалось добавить ссылку в список.")
 
+class BandwidthManager:
+    """Global and per-site bandwidth caps plus per-site job budgets.
 
-def main() -> None:
-    """Запускает горячие клавиши и значок в трее."""
-    ensure_single_instance()
-    config = load_config()
-    ensure_directories()
-    if not os.path.exists(DOWNLOAD_LIST):
-        open(DOWNLOAD_LIST, 'a', encoding='utf-8').close()
+    Settings come from ``[bandwidth]`` in config.ini; sections named
+    ``[bandwidth:<profile>]`` with ``hours`` (and optionally ``days``)
+    override them while the profile is active::
 
-    add_hotkey = config.get('add_hotkey', DEFAULT_CONFIG['add_hotkey'])
-    download_hotkey = config.get('download_hotkey', DEFAULT_CONFIG['download_hotkey'])
+        [bandwidth]
+        limit = 0
+        youtube_jobs = 2
 
-    # Функция-обёртка для добавления ссылки с краткой сменой иконки
-    def on_add(icon: pystray.Icon):
-        flash_tray_icon(icon, ICON_ACTIVE)
-        add_link_from_clipboard()
+        [bandwidth:work]
+        hours = 09:00-18:00
+        days = mon-fri
+        limit = 2M
+        youtube = 1M
+    """
 
-    # Меняем горячую клавишу
-    def change_hotkey(icon, item):
-        icon.notify('Настройка', 'Нажмите новое сочетание и Enter')
-        hotkey_manager.unregister_all()
-        hotkey_manager.stop_listener()
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.buckets = {key: TokenBucket() for key in BANDWIDTH_KEYS}
+        self.profile = ''
+        self.settings: dict[str, str] = {}
+        self._loaded = 0.0
+
+    def refresh(self, force: bool = False) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._loaded < BANDWIDTH_REFRESH:
+                return
+            self._loaded = now
+        parser = configparser.ConfigParser()
         try:
-            new_key = keyboard.read_hotkey()
-            if new_key:
-                config['add_hotkey'] = new_key
-                save_config(config)
-                icon.notify('Готово', f'Новая клавиша: {new_key}')
+            parser.read(CONFIG_FILE, encoding='utf-8')
         except Exception as e:
-            logging.error('Ошибка смены горячей клавиши: %s', e)
-        finally:
-            hotkey_manager.start_listener()
-            # Восстанавливаем привязки
-            hotkey_manager.register(config['add_hotkey'], lambda: on_add(icon))
-            hotkey_manager.register(config['download_hotkey'], lambda: download_all(icon))
+            logging.error('Ошибка загрузки конфигурации: %s', e)
+        settings = dict(parser.items('bandwidth')) if parser.has_section('bandwidth') else {}
+        profile = ''
+        current = datetime.datetime.now()
+        for section in parser.sections():
+            if not section.startswith('bandwidth:'):
+                continue
+            values = dict(parser.items(section))
+            try:
+                active = (
+                    'hours' not in values or _in_hours(values['hours'], current)
+                ) and _in_days(values.get('days', ''), current)
+            except ValueError as e:
+                logging.error('Неверный профиль [%s]: %s', section, e)
+                continue
+            if active:
+                profile = section.split(':', 1)[1]
+                settings.update(values)
+        for key, bucket in self.buckets.items():
+            try:
+                bucket.set_rate(parse_rate(settings.get(key, '0')))
+            except ValueError:
+                logging.error('Неверное ограничение скорости %s = %r', key, settings.get(key))
+        if profile != self.profile:
+            logging.info('Профиль скорости: %s', profile or 'по умолчанию')
+        self.profile, self.settings = profile, settings
 
-    # Меню «Скачать»
-    def on_download(icon, item):
-        download_all(icon)
+    def _site(self, site: Optional[str]) -> str:
+        site = BANDWIDTH_SITE_ALIASES.get(site or 'other', site or 'other')
+        return site if site in self.buckets else 'other'
 
-    # Выход
-    def on_exit(icon, item):
-        icon.stop()
+    def reserve(self, n: int, site: Optional[str] = None) -> float:
+        """Account ``n`` transferred bytes; return the delay the caps require."""
+        self.refresh()
+        return max(self.buckets[self._site(site)].reserve(n), self.buckets['limit'].reserve(n))
 
-    # Открыть список загрузок
-    def open_list(icon, item):
-        try:
-            if sys.platform.startswith('win'):
-                os.startfile(DOWNLOAD_LIST)
-            else:
-                subprocess.Popen(['xdg-open', DOWNLOAD_LIST])
-        except Exception as e:
-            logging.error('Не удалось открыть файл со списком: %s', e)
+    def throttle(self, n: int, site: Optional[str] = None) -> None:
+        """Account ``n`` transferred bytes, sleeping if a cap is exceeded."""
+        wait = self.reserve(n, site)
+        if wait > 0:
+            time.sleep(wait)
 
-    # Открыть папку загрузок
-    def open_folder(icon, item):
-        try:
-            if sys.platform.startswith('win'):
-                os.startfile(DOWNLOADS_FOLDER)
-            else:
-                subprocess.Popen(['xdg-open', DOWNLOADS_FOLDER])
-        except Exception as e:
-            logging.error('Не удалось открыть папку загрузок: %s', e)
+    def site_rate(self, site: str) -> float:
+        """Effective cap for a single transfer of ``site`` (0 — unlimited)."""
+        self.refresh()
+        rates = [r for r in (self.buckets[self._site(site)].rate, self.buckets['limit'].rate) if r > 0]
+        return min(rates) if rates else 0.0
 
-    # Информация
-    def show_info(icon, item):
+    def concurrency(self) -> tuple[int, dict[str, int]]:
+        """``(max_workers, per-site job limits)`` for the scheduler."""
+        self.refresh()
+        max_workers = MAX_WORKERS
+        limits: dict[str, int] = {}
         try:
-            if os.path.exists(INFO_FILE):
-                if sys.platform.startswith('win'):
-                    os.startfile(INFO_FILE)
-                else:
-                    subprocess.Popen(['xdg-open', INFO_FILE])
-            else:
-                icon.notify('Информация', 'Файл info.txt не найден')
-        except Exception as e:
-            logging.error('Не удалось открыть info.txt: %s', e)
+            max_workers = int(self.settings.get('max_workers', MAX_WORKERS))
+            for site in SITE_LIMITS:
+                if f'{site}_jobs' in self.settings:
+                    limits[site] = max(1, int(self.settings[f'{site}_jobs']))
+        except ValueError as e:
+            logging.error('Неверный лимит параллельности: %s', e)
+        return max_workers, limits
 
-    # Составляем меню
-    menu = pystray.Menu(
-        pystray.MenuItem('Скачать', on_download),
-        pystray.MenuItem('Список загрузок', open_list),
-        pystray.MenuItem('Открыть папку для загрузки', open_folder),
-        pystray.MenuItem('Горячие клавиши', change_hotkey),
-        pystray.MenuItem('Инфо', show_info),
-        pystray.MenuItem('Выход', on_exit),
-    )
 
-    # Иконка в трее
-    tray_icon = pystray.Icon('YTDownloader', ICON_DEFAULT, 'YT Downloader', menu)
+bandwidth = BandwidthManager()
 
-    # Привязка горячих клавиш
-    hotkey_manager.register(add_hotkey, lambda: on_add(tray_icon))
-    hotkey_manager.register(download_hotkey, lambda: download_all(tray_icon))
 
-    print(f"Значок размещён в трее. Горячие клавиши {add_hotkey} и {download_hotkey} активны.")
+def transferred(n: int) -> None:
+    """Report ``n`` bytes moved by the current job to metrics and the shaper."""
+    metrics.add_bytes(n)
+    jm = _current_job.get()
+    bandwidth.throttle(n, jm.site if jm is not None else None)
+
+
+# === HTTP-клиент ===
+HTTP_USER_AGENT = 'Mozilla/5.0'
+HTTP_TIMEOUT = (5, 30)  # (соединение, чтение), секунды
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+# Самая долгая пауза перед повтором, в том числе по Retry-After сервера
+HTTP_BACKOFF_MAX = 30.0
+HTTP_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+HTTP_POOL_HOSTS = 100
+HTTP_POOL_SIZE = 16
+# Запросов в секунду на один хост; 0 — без ограничения
+HTTP_HOST_RATE = 20.0
+HTTP_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+CHUNK_SIZE = 64 * 1024
+# Файлы от этого размера качаются по частям через несколько соединений
+SEGMENT_CONNECTIONS = 4
+SEGMENT_MIN_SIZE = 8 * 1024 * 1024
+# Как часто сохраняется прогресс частей (для докачки .part), секунды
+SEGMENT_SAVE_INTERVAL = 2.0
+
+
+def http_stream_errors() -> tuple[type[Exception], ...]:
+    """Exceptions of a connection dropped in the middle of a response body."""
+    import requests
+    return (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+def stream_to_file(resp: 'requests.Response', path: str, hasher=None) -> int:
+    """Stream ``resp`` body into ``path`` via a ``.part`` file; return bytes written."""
+    tmp = f"{path}.part"
+    written = 0
+    try:
+        with open(tmp, 'wb') as f:
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                written += len(chunk)
+                transferred(len(chunk))
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return written
+
+
+class StreamHash:
+    """SHA-256 of a file being downloaded; :meth:`reset` starts it over on a retry."""
+
+    def __init__(self) -> None:
+        self._hash = hashlib.sha256()
+
+    def reset(self) -> None:
+        self._hash = hashlib.sha256()
+
+    def update(self, data: bytes) -> None:
+        self._hash.update(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def _hash_file(path: str, hasher: StreamHash) -> None:
+    hasher.reset()
+    with open(path, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, CHUNK_SIZE * 16), b''):
+            hasher.update(chunk)
+
+
+class SegmentedDownload:
+    """HTTP Range download of one file over several connections.
+
+    The output is preallocated as ``<path>.part``; the byte ranges already
+    flushed to disk are kept in ``<path>.part.json`` so an interrupted
+    download resumes where it stopped.  Range requests carry ``If-Range``
+    with the ETag (or Last-Modified), so a file changed on the server is
+    never stitched together from two versions.
+    """
+
+    def __init__(self, client: 'HttpClient', url: str, path: str, connections: int, kwargs: dict) -> None:
+        self.client = client
+        self.url = url
+        self.path = path
+        self.part = f"{path}.part"
+        self.meta = f"{self.part}.json"
+        self.connections = max(1, connections)
+        self.kwargs = kwargs
+        self.state: dict = {}
+        self._lock = threading.Lock()
+
+    def _save(self) -> None:
+        with self._lock:
+            atomic_write_text(self.meta, json.dumps(self.state))
+
+    def discard(self) -> None:
+        for name in (self.part, self.meta):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    def resume(self) -> bool:
+        """Load the state of an interrupted download of the same URL."""
+        try:
+            with open(self.meta, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('url') == self.url and os.path.getsize(self.part) == state['size']:
+                self.state = state
+                return True
+        except (OSError, ValueError, KeyError):
+            pass
+        self.discard()
+        return False
+
+    def plan(self, resp: 'requests.Response') -> bool:
+        """Split the file described by ``resp`` if ranges are worth using."""
+        headers = resp.headers
+        size = int(headers.get('Content-Length') or 0)
+        if (
+            self.connections < 2
+            or size < SEGMENT_MIN_SIZE
+            or headers.get('Accept-Ranges', '').lower() != 'bytes'
+            or headers.get('Content-Encoding', 'identity').lower() != 'identity'
+        ):
+            return False
+        step = -(-size // self.connections)
+        self.state = {
+            'url': self.url,
+            'size': size,
+            'validator': headers.get('ETag') or headers.get('Last-Modified') or '',
+            'segments': [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)],
+        }
+        with open(self.part, 'wb') as f:
+            f.truncate(size)
+        self._save()
+        return True
+
+    def _fetch_segment(self, index: int, resp: Optional['requests.Response'] = None) -> int:
+        import requests
+        seg = self.state['segments'][index]
+        start, end = seg[0], seg[1]
+        received = 0
+        attempts = self.client.retries + 1
+        for attempt in range(attempts):
+            pos = start + seg[2]
+            if pos > end:
+                return received
+            try:
+                if resp is None:
+                    headers = {'Range': f"bytes={pos}-{end}"}
+                    if self.state['validator']:
+                        headers['If-Range'] = self.state['validator']
+                    resp = self.client.get(self.url, stream=True, headers=headers, **self.kwargs)
+                    if resp.status_code != 206:
+                        resp.close()
+                        raise requests.HTTPError(
+                            f"сервер не вернул часть файла (HTTP {resp.status_code})", response=resp
+                        )
+                pending = 0
+                saved = time.monotonic()
+                with resp, open(self.part, 'r+b') as f:
+                    f.seek(pos)
+                    for chunk in resp.iter_content(CHUNK_SIZE):
+                        chunk = chunk[:end + 1 - pos]
+                        f.write(chunk)
+                        pos += len(chunk)
+                        pending += len(chunk)
+                        received += len(chunk)
+                        transferred(len(chunk))
+                        if pos > end or time.monotonic() - saved >= SEGMENT_SAVE_INTERVAL:
+                            f.flush()
+                            os.fsync(f.fileno())
+                            with self._lock:
+                                seg[2] += pending
+                            pending = 0
+                            self._save()
+                            saved = time.monotonic()
+                        if pos > end:
+                            break
+                    f.flush()
+                    with self._lock:
+                        seg[2] += pending
+                resp = None
+                if pos > end:
+                    return received
+                raise requests.ConnectionError('соединение закрыто до конца части')
+            except http_stream_errors():
+                resp = None
+                self._save()
+                if attempt + 1 >= attempts:
+                    raise
+                metrics.add_retry()
+                time.sleep(self.client._delay(attempt, None))
+        return received
+
+    def run(self, first: Optional['requests.Response'] = None) -> int:
+        """Download the missing ranges; ``first`` may serve the first segment."""
+        import requests
+        segments = self.state['segments']
+        with ThreadPoolExecutor(max_workers=min(self.connections, len(segments))) as pool:
+            futures = [
+                submit_with_context(pool, self._fetch_segment, i, first if i == 0 else None)
+                for i in range(len(segments))
+            ]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        stale = [e for e in errors if isinstance(e, requests.HTTPError)]
+        if stale:
+            # If-Range не совпал — файл на сервере изменился, сохранённые части
+            # не годятся; следующая попытка начнёт заново
+            self.discard()
+            self.state = {}
+            raise stale[0]
+        if errors:
+            raise errors[0]
+        received = sum(f.result() for f in futures)
+        if any(seg[0] + seg[2] <= seg[1] for seg in segments):
+            raise requests.ConnectionError('файл скачан не полностью')
+        if os.path.getsize(self.part) != self.state['size']:
+            self.discard()
+            self.state = {}
+            raise requests.HTTPError('размер скачанного файла не совпадает с заявленным')
+        os.replace(self.part, self.path)
+        try:
+            os.remove(self.meta)
+        except OSError:
+            pass
+        return received
+
+
+class HostStats:
+    """Request counters and a latency histogram for a single host."""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        self.errors = 0
+        self.latency = [0] * len(HTTP_LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.next_slot = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.latency[bisect.bisect_left(HTTP_LATENCY_BUCKETS, seconds)] += 1
+        self.latency_sum += seconds
+
+    def as_dict(self) -> dict:
+        return {
+            'requests': self.requests,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'errors': self.errors,
+            'latency': {
+                ('+Inf' if math.isinf(le) else str(le)): n
+                for le, n in zip(HTTP_LATENCY_BUCKETS, self.latency)
+            },
+            'latency_sum': round(self.latency_sum, 6),
+        }
+
+
+class HttpClient:
+    """Shared HTTP layer for every non-yt-dlp fetch.
+
+    One keep-alive :class:`requests.Session` with a connection pool per host,
+    retries with exponential backoff and jitter on 429/5xx and network errors,
+    a minimal interval between requests to the same host and per-host
+    counters (see :meth:`stats`).
+    """
+
+    def __init__(
+        self,
+        timeout: float | tuple[float, float] = HTTP_TIMEOUT,
+        retries: int = HTTP_RETRIES,
+        backoff: float = HTTP_BACKOFF,
+        host_rate: float = HTTP_HOST_RATE,
+        pool_size: int = HTTP_POOL_SIZE,
+    ) -> None:
+        self.timeout = timeout
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.host_rate = host_rate
+        self.pool_size = pool_size
+        self._session: Optional['requests.Session'] = None
+        self._lock = threading.Lock()
+        self._hosts: dict[str, HostStats] = defaultdict(HostStats)
+
+    @property
+    def session(self) -> 'requests.Session':
+        """The keep-alive session, created (and ``requests`` imported) on first use."""
+        if self._session is None:
+            import requests
+            import requests.adapters
+            session = requests.Session()
+            session.headers['User-Agent'] = HTTP_USER_AGENT
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=HTTP_POOL_HOSTS, pool_maxsize=self.pool_size, max_retries=0
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            with self._lock:
+                if self._session is None:
+                    self._session = session
+        return self._session
+
+    def _host(self, url: str) -> str:
+        parsed = urlparse(url)
+        return parsed.netloc.lower()
+
+    def _reserve(self, host: str) -> float:
+        """Book the next request slot of ``host``; return how long to wait for it."""
+        if self.host_rate <= 0:
+            return 0.0
+        with self._lock:
+            stats = self._hosts[host]
+            now = time.monotonic()
+            slot = max(now, stats.next_slot)
+            stats.next_slot = slot + 1.0 / self.host_rate
+        return slot - now
+
+    def _throttle(self, host: str) -> None:
+        wait = self._reserve(host)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _observe(self, host: str, elapsed: float, error: bool = False) -> None:
+        with self._lock:
+            stats = self._hosts[host]
+            stats.requests += 1
+            stats.errors += error
+            stats.observe(elapsed)
+
+    def _retried(self, host: str) -> None:
+        with self._lock:
+            self._hosts[host].retries += 1
+        metrics.add_retry()
+
+    def _delay(self, attempt: int, resp: Optional['requests.Response']) -> float:
+        retry_after = resp.headers.get('Retry-After') if resp is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), HTTP_BACKOFF_MAX)
+        return min(self.backoff * (2 ** attempt) + random.uniform(0, self.backoff), HTTP_BACKOFF_MAX)
+
+    def count_bytes(self, url: str, n: int) -> None:
+        with self._lock:
+            self._hosts[self._host(url)].bytes += n
+
+    def request(self, method: str, url: str, *, retry: bool = True, **kwargs) -> 'requests.Response':
+        """Send a request, retrying transient failures.
+
+        The last response is returned even if its status is an error, so that
+        callers keep deciding what a 404 means.  Network errors are re-raised
+        once the retry budget is spent.
+        """
+        import requests
+        host = self._host(url)
+        kwargs.setdefault('timeout', self.timeout)
+        attempts = self.retries + 1 if retry else 1
+        for attempt in range(attempts):
+            self._throttle(host)
+            started = time.monotonic()
+            resp = None
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._observe(host, time.monotonic() - started, error=True)
+                if attempt + 1 >= attempts:
+                    raise
+            else:
+                self._observe(host, time.monotonic() - started)
+            if resp is not None:
+                if resp.status_code not in HTTP_RETRY_STATUSES or attempt + 1 >= attempts:
+                    if not kwargs.get('stream'):
+                        self.count_bytes(url, len(resp.content))
+                        transferred(len(resp.content))
+                    return resp
+                resp.close()
+            self._retried(host)
+            time.sleep(self._delay(attempt, resp))
+        raise RuntimeError('unreachable')
+
+    def get(self, url: str, **kwargs) -> 'requests.Response':
+        return self.request('GET', url, **kwargs)
+
+    def download(
+        self, url: str, path: str, connections: int = SEGMENT_CONNECTIONS,
+        headers: Optional[dict] = None, hasher=None, **kwargs
+    ) -> Optional[int]:
+        """Download ``url`` into ``path`` (atomically); return the bytes received.
+
+        Large files served with ``Accept-Ranges: bytes`` are fetched over
+        ``connections`` parallel Range requests and can be resumed from their
+        ``.part`` file (see :class:`SegmentedDownload`); anything else is
+        streamed over a single connection.  ``headers`` go with the first
+        request only; if they are conditional and the server answers
+        ``304 Not Modified``, ``path`` is left alone and ``None`` returned.
+        ``hasher`` (a :class:`StreamHash`) ends up with the digest of the
+        saved file; it is reset whenever an attempt starts over.
+        """
+        import requests
+        segmented = SegmentedDownload(self, url, path, connections, kwargs)
+        if segmented.resume():
+            try:
+                written = segmented.run()
+            except requests.HTTPError as e:
+                if segmented.state:
+                    raise
+                logging.info('Докачка %s невозможна (%s), качаем заново', url, e)
+            else:
+                self.count_bytes(url, written)
+                if hasher is not None:
+                    _hash_file(path, hasher)
+                return written
+        attempts = self.retries + 1
+        for attempt in range(attempts):
+            if hasher is not None:
+                hasher.reset()
+            with self.get(url, stream=True, headers=headers, **kwargs) as resp:
+                if resp.status_code == 304:
+                    return None
+                resp.raise_for_status()
+                try:
+                    if segmented.plan(resp):
+                        written = segmented.run(first=resp)
+                        if hasher is not None:
+                            # Части приходят вразнобой — файл хешируется после сборки
+                            _hash_file(path, hasher)
+                    else:
+                        written = stream_to_file(resp, path, hasher)
+                except http_stream_errors():
+                    if segmented.state or attempt + 1 >= attempts:
+                        # Частично скачанный файл докачается при следующей попытке задачи
+                        raise
+                    self._retried(self._host(url))
+                    time.sleep(self._delay(attempt, None))
+                    continue
+            self.count_bytes(url, written)
+            return written
+        raise RuntimeError('unreachable')
+
+    def stats(self) -> dict[str, dict]:
+        """Return a snapshot of the per-host counters."""
+        with self._lock:
+            return {host: st.as_dict() for host, st in self._hosts.items()}
+
+    def format_stats(self) -> str:
+        lines = []
+        for host, st in sorted(self.stats().items()):
+            lines.append(
+                f"{host}: запросов {st['requests']}, повторов {st['retries']}, "
+                f"ошибок {st['errors']}, {st['bytes'] / 1048576:.2f} МБ"
+            )
+        return "\n".join(lines)
+
+
+http_client = HttpClient()
+
+
+def _ydl_output_files(info: Optional[dict]) -> list[str]:
+    """Collect the files yt-dlp wrote for ``info`` (video or playlist)."""
+    if not info:
+        return []
+    if info.get('_type') == 'playlist':
+        files: list[str] = []
+        for entry in info.get('entries') or []:
+            files.extend(_ydl_output_files(entry))
+        return files
+    files = []
+    for item in info.get('requested_downloads') or [info]:
+        path = item.get('filepath') or item.get('_filename')
+        if path and os.path.exists(path):
+            files.append(path)
+    return files
+
+
+class YtdlEngine:
+    """Long-lived ``YoutubeDL`` instances shared by every URL of a batch.
+
+    Instances are created once per option set and handed out one thread at a
+    time, so extractor setup, cookies and the player-JS cache are paid for
+    once per batch instead of once per URL.  yt-dlp's own on-disk cache lives
+    in :data:`YTDL_CACHE_DIR`, so later runs start warm as well.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._idle: dict[str, list['yt_dlp.YoutubeDL']] = defaultdict(list)
+        self._all: list['yt_dlp.YoutubeDL'] = []
+
+    @contextmanager
+    def acquire(self, opts: dict, cache: bool = True):
+        """Hand out an instance for ``opts``.
+
+        With ``cache=False`` the options are one-off (a per-file output
+        template, say): the instance is created for this call and closed on
+        exit instead of being kept for the rest of the batch.
+        """
+        import yt_dlp
+        if not cache:
+            ydl = yt_dlp.YoutubeDL({'cachedir': YTDL_CACHE_DIR, **opts})
+            try:
+                yield ydl
+            finally:
+                ydl.close()
+            return
+        key = json.dumps(opts, sort_keys=True, default=str)
+        with self._lock:
+            ydl = self._idle[key].pop() if self._idle[key] else None
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL({'cachedir': YTDL_CACHE_DIR, **opts})
+            with self._lock:
+                self._all.append(ydl)
+        try:
+            yield ydl
+        finally:
+            with self._lock:
+                self._idle[key].append(ydl)
+
+    def close(self) -> None:
+        with self._lock:
+            instances, self._all = self._all, []
+            self._idle.clear()
+        for ydl in instances:
+            try:
+                ydl.close()
+            except Exception as e:
+                logging.error('Ошибка при закрытии yt-dlp: %s', e)
+
+
+@contextmanager
+def _engine_or_oneshot(engine: Optional[YtdlEngine]):
+    """Yield ``engine`` or a temporary one closed on exit."""
+    if engine is not None:
+        yield engine
+        return
+    engine = YtdlEngine()
+    try:
+        yield engine
+    finally:
+        engine.close()
+
+
+# === Форматы YouTube ===
+# [formats] в config.ini: default — профиль по умолчанию, youtube / playlist —
+# для папки этого обработчика; метка в списке ("[audio] https://...") важнее.
+# Профили: best, audio, 1080p, 720p, 480p... ffmpeg — путь, если его нет в PATH
+FORMAT_DEFAULTS = {
+    'default': 'best',
+    'youtube': '',
+    'playlist': '',
+    'audio_bitrate': 160,
+    'merge_format': 'mp4',
+    'audio_format': '',
+    'ffmpeg': '',
+    'ffmpeg_args': '',
+}
+_RESOLUTION_TAG_RE = re.compile(r'^(\d{3,4})p$')
+
+
+@dataclass(frozen=True)
+class FormatProfile:
+    """yt-dlp ``format`` / ``format_sort`` for one quality target.
+
+    The sort puts the target first and ``+size`` last, so among formats that
+    meet the target the smallest one wins.
+    """
+
+    name: str
+    format: str
+    sort: tuple[str, ...]
+    audio_only: bool = False
+
+
+def is_format_tag(tag: str) -> bool:
+    return tag in ('best', 'audio') or bool(_RESOLUTION_TAG_RE.match(tag))
+
+
+def format_profile(name: Optional[str] = None, site: str = 'youtube') -> FormatProfile:
+    """Profile for a list tag; without one — from ``[formats]`` in config.ini."""
+    cfg = load_section('formats', FORMAT_DEFAULTS)
+    name = (name or cfg.get(site) or cfg['default'] or 'best').strip().lower()
+    if name == 'audio':
+        return FormatProfile(name, 'ba/b', (f"abr:{cfg['audio_bitrate']}", '+size'), audio_only=True)
+    if m := _RESOLUTION_TAG_RE.match(name):
+        return FormatProfile(name, 'bv*+ba/b', (f"res:{m.group(1)}", 'fps', '+size'))
+    if name != 'best':
+        logging.warning('Неизвестный профиль формата %r, используется best', name)
+    return FormatProfile('best', 'bv*+ba/b', ('res', 'fps', '+size'))
+
+
+def find_ffmpeg(configured: str = '') -> Optional[str]:
+    """Path of the ffmpeg binary from config.ini or ``PATH``."""
+    if configured:
+        return configured if os.path.isfile(configured) else shutil.which(configured)
+    return shutil.which('ffmpeg')
+
+
+def _estimated_size(info: dict, duration: Optional[float]) -> Optional[float]:
+    """Bytes of a format selection; from the bitrate when yt-dlp gives no size."""
+    total = 0.0
+    for f in info.get('requested_formats') or [info]:
+        size = f.get('filesize') or f.get('filesize_approx')
+        if not size and f.get('tbr') and duration:
+            size = f['tbr'] * 125 * duration  # кбит/с -> байты
+        if not size:
+            return None
+        total += size
+    return total
+
+
+def _report_formats(engine: YtdlEngine, raw: dict, chosen: dict, hook: Callable) -> None:
+    """Send the size of ``chosen`` and of the old ``'best'`` choice to ``hook``."""
+    duration = raw.get('duration')
+    try:
+        with engine.acquire({'format': 'best', 'quiet': True, 'no_warnings': True}) as ydl:
+            best = _estimated_size(ydl.process_ie_result(copy.deepcopy(raw), download=False), duration)
+    except Exception:
+        # У сайта нет готового файла «видео+звук» — 'best' не скачал бы ничего
+        best = None
+    hook({'status': 'formats', 'chosen_bytes': _estimated_size(chosen, duration), 'best_bytes': best})
+
+
+def ffmpeg_merge(ffmpeg: str, video: str, audio: str, output: str, extra: str = '') -> None:
+    """Mux ``video`` and ``audio`` into ``output`` without re-encoding."""
+    root, ext = os.path.splitext(output)
+    temp = f"{root}.temp{ext}"
+    cmd = [
+        ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', '-i', video, '-i', audio,
+        '-map', '0:v:0', '-map', '1:a:0', '-c', 'copy', *shlex.split(extra), temp,
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, errors='replace')
+    if result.returncode:
+        if os.path.exists(temp):
+            os.remove(temp)
+        tail = result.stderr.strip().splitlines()[-1:] or [f"код {result.returncode}"]
+        raise RuntimeError(f"ffmpeg: {tail[0]}")
+    os.replace(temp, output)
+
+
+def _download_streams(
+    engine: YtdlEngine, raw: dict, chosen: dict, output: str, opts: dict,
+    ffmpeg: str, cfg: dict, hook: Callable,
+) -> list[str]:
+    """Download the video and audio streams of ``chosen`` in parallel and merge into ``output``."""
+    base = os.path.splitext(output)[0].replace('%', '%%')
+    streams = chosen['requested_formats']
+    rate = opts.get('ratelimit')
+
+    def fetch(fmt: dict) -> str:
+        stream_opts = {
+            **opts,
+            'format': fmt['format_id'],
+            'outtmpl': f"{base}.f%(format_id)s.%(ext)s",
+            'postprocessors': [],
+        }
+        if rate:
+            # Общий предел сайта делится между потоками одного видео
+            stream_opts['ratelimit'] = rate / len(streams)
+        # Шаблон имени свой у каждого видео — такой экземпляр не переиспользовать
+        with engine.acquire(stream_opts, cache=False) as ydl:
+            files = _ydl_output_files(ydl.process_ie_result(copy.deepcopy(raw), download=True))
+        if not files:
+            raise RuntimeError(f"поток {fmt['format_id']} не скачан")
+        return files[0]
+
+    with ThreadPoolExecutor(max_workers=len(streams), thread_name_prefix='ytdl-stream') as pool:
+        parts = [f.result() for f in [submit_with_context(pool, fetch, fmt) for fmt in streams]]
+    hook({'status': 'merging', 'filename': output})
+    ffmpeg_merge(ffmpeg, parts[0], parts[-1], output, cfg['ffmpeg_args'])
+    for part in parts:
+        os.remove(part)
+    return [output]
+
+
+def download_video(
+    url, folder, engine: Optional[YtdlEngine] = None, profile: Optional[str] = None
+):
+    """Скачивает видео в процессе из :data:`ytdl_pool` или, если он выключен, здесь."""
+    if ytdl_pool.enabled:
+        return ytdl_pool.download(url, folder, profile)
+    return download_video_local(url, folder, engine, profile=profile)
+
+
+def download_video_local(
+    url, folder, engine: Optional[YtdlEngine] = None, hook: Optional[Callable] = None,
+    profile: Optional[str] = None,
+):
+    """Скачивает видео в текущем процессе; ``hook`` получает прогресс и постобработку.
+
+    Formats are picked by :func:`format_profile`.  When the choice is a
+    separate video and audio stream, both are downloaded in parallel and
+    merged by :func:`ffmpeg_merge`; without ffmpeg only single-file formats
+    are used.
+    """
+    progress = hook or metrics.ytdl_hook
+    cfg = load_section('formats', FORMAT_DEFAULTS)
+    policy = format_profile(profile)
+    ffmpeg = find_ffmpeg(cfg['ffmpeg'])
+    ydl_opts = {
+        'format': policy.format if ffmpeg or policy.audio_only else 'b',
+        'format_sort': list(policy.sort),
+        'outtmpl': os.path.join(folder, '%(title)s [%(id)s].%(ext)s'),
+        'merge_output_format': cfg['merge_format'],
+        'quiet': False,
+        'no_warnings': True,
+        'progress_hooks': [progress],
+    }
+    if profile:
+        # Копия по метке не должна совпасть по имени с обычной: "Название [id] (720p).mp4"
+        ydl_opts['outtmpl'] = os.path.join(folder, f"%(title)s [%(id)s] ({policy.name}).%(ext)s")
+    if hook is not None:
+        ydl_opts['postprocessor_hooks'] = [hook]
+    if ffmpeg:
+        ydl_opts['ffmpeg_location'] = ffmpeg
+        if policy.audio_only and cfg['audio_format']:
+            ydl_opts['postprocessors'] = [
+                {'key': 'FFmpegExtractAudio', 'preferredcodec': cfg['audio_format']},
+            ]
+    ratelimit = bandwidth.site_rate('youtube')
+    if ratelimit:
+        ydl_opts['ratelimit'] = ratelimit
+    try:
+        with _engine_or_oneshot(engine) as eng:
+            with eng.acquire(ydl_opts) as ydl:
+                raw = ydl.extract_info(url, download=False, process=False)
+                if not raw or raw.get('_type', 'video') != 'video':
+                    # Перенаправление или плейлист: форматы выберет сам yt-dlp
+                    return _ydl_output_files(ydl.process_ie_result(raw, download=True))
+                chosen = ydl.process_ie_result(copy.deepcopy(raw), download=False)
+                output = ydl.prepare_filename(chosen)
+            _report_formats(eng, raw, chosen, progress)
+            if ffmpeg and len(chosen.get('requested_formats') or ()) == 2:
+                return _download_streams(eng, raw, chosen, output, ydl_opts, ffmpeg, cfg, progress)
+            with eng.acquire(ydl_opts) as ydl:
+                return _ydl_output_files(ydl.process_ie_result(raw, download=True))
+    except Exception as e:
+        logging.error('Ошибка при скачивании YouTube-содержимого: %s', e)
+        print(f"Ошибка при скачивании YouTube-содержимого: {e}")
+        return []
+
+
+# Сколько видео плейлиста скачивается одновременно (playlist_workers в [youtube])
+PLAYLIST_WORKERS = 3
+
+
+def expand_playlist(url: str, engine: Optional[YtdlEngine] = None) -> list[dict]:
+    """Return the flat entries (``id``, ``url``, ``title``) of a playlist."""
+    ydl_opts = {
+        'extract_flat': 'in_playlist',
+        'quiet': True,
+        'no_warnings': True,
+        'yes_playlist': True,
+    }
+    with _engine_or_oneshot(engine) as eng, eng.acquire(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    return [e for e in (info or {}).get('entries') or [] if e and e.get('id')]
+
+
+def download_playlist(
+    url, folder, workers: Optional[int] = None, engine: Optional[YtdlEngine] = None,
+    profile: Optional[str] = None,
+):
+    """Expand the playlist and download the missing entries in parallel.
+
+    Finished entries go to the download index one by one, so an interrupted
+    playlist resumes from the first video that is not on disk yet.  Entries
+    of a tagged playlist (``[audio] https://...``) are indexed per profile.
+    ``workers`` defaults to ``playlist_workers`` of ``[youtube]``.
+    """
+    workers = workers or load_section('youtube', YOUTUBE_DEFAULTS)['playlist_workers']
+    profile = profile or load_section('formats', FORMAT_DEFAULTS)['playlist'] or None
+    suffix = f":{profile}" if profile else ''
+
+    try:
+        entries = expand_playlist(url, engine)
+    except Exception as e:
+        logging.error('Ошибка при разборе плейлиста: %s', e)
+        print(f"Ошибка при разборе плейлиста: {e}")
+        return []
+    if not entries:
+        print("Плейлист пуст или недоступен.")
+        return []
+
+    on_disk: dict[str, list[str]] = defaultdict(list)
+    # Копия по метке узнаётся по "(профиль)" в имени, обычная — по его отсутствию
+    tag = format_profile(profile).name if profile else None
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            m = _VIDEO_FILE_RE.search(name)
+            if m and m.group(2) == tag and not name.endswith(('.part', '.ytdl')):
+                on_disk[m.group(1)].append(os.path.join(folder, name))
+
+    files: list[str] = []
+    todo: list[dict] = []
+    for entry in entries:
+        key = f"youtube:{entry['id']}{suffix}"
+        existing = download_index.lookup(key) or on_disk.get(entry['id'])
+        if existing:
+            download_index.record(key, existing)
+            files.extend(existing)
+        else:
+            todo.append(entry)
+    print(
+        f"Плейлист: {len(entries)} видео, уже скачано {len(entries) - len(todo)}, "
+        f"осталось {len(todo)}"
+    )
+
+    def fetch(entry: dict) -> list[str]:
+        entry_url = entry.get('url') or f"https://www.youtube.com/watch?v={entry['id']}"
+        result = download_video(entry_url, folder, engine, profile)
+        if result:
+            download_index.record(f"youtube:{entry['id']}{suffix}", result)
+        return result
+
+    failed = 0
+    with _engine_or_oneshot(engine) as engine, ThreadPoolExecutor(
+        max_workers=max(1, workers), thread_name_prefix='playlist'
+    ) as pool:
+        futures = [submit_with_context(pool, fetch, entry) for entry in todo]
+        for result in (f.result() for f in futures):
+            if result:
+                files.extend(result)
+            else:
+                failed += 1
+    if failed:
+        logging.error('Плейлист %s: не скачано видео: %d', url, failed)
+        print(f"Не удалось скачать видео из плейлиста: {failed}. Они будут скачаны при следующем запуске.")
+        return PartialFiles(files)
+    return files
+
+
+# === Процессы yt-dlp ===
+# [youtube] в config.ini: processes = 0 — качать в процессе трея, как раньше;
+# timeout — предел на одно видео, stall_timeout — сколько ждать без прогресса
+# (обе в секундах, 0 — без ограничения); playlist_workers — видео плейлиста
+# одновременно
+YOUTUBE_DEFAULTS = {
+    'processes': min(4, os.cpu_count() or 1),
+    'timeout': 0.0,
+    'stall_timeout': 900.0,
+    'playlist_workers': PLAYLIST_WORKERS,
+}
+YTDL_POLL_INTERVAL = 0.5
+_YTDL_PROGRESS_KEYS = ('status', 'filename', 'downloaded_bytes', 'eta', 'chosen_bytes', 'best_bytes')
+
+
+def _ytdl_worker(conn: 'Connection') -> None:
+    """Loop of a worker process: ``(url, folder, profile)`` in, progress and files out."""
+    _ignore_sigint()
+    if hasattr(os, 'setpgrp'):
+        # Своя группа: вместе с воркером убиваются и его ffmpeg
+        os.setpgrp()
+    engine = YtdlEngine()
+
+    def hook(d: dict) -> None:
+        conn.send(('progress', {k: d.get(k) for k in _YTDL_PROGRESS_KEYS}))
+
+    try:
+        while True:
+            try:
+                task = conn.recv()
+            except EOFError:
+                break
+            if task is None:
+                break
+            url, folder, profile = task
+            conn.send(('done', download_video_local(url, folder, engine, hook, profile)))
+    finally:
+        engine.close()
+
+
+def _kill_process_tree(process: 'multiprocessing.Process') -> None:
+    """Kill a worker together with the ffmpeg processes it started."""
+    if not process.is_alive():
+        return
+    if os.name == 'nt':
+        # /T — всё дерево: ffmpeg склейки, извлечения звука и HLS
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True)
+    else:
+        try:
+            if os.getpgid(process.pid) == process.pid:
+                os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    if process.is_alive():
+        process.kill()
+
+
+# Недокачанное и промежуточное после "Название [id]": .mp4.part, .part-Frag3,
+# .ytdl, потоки .f137.mp4 и файлы ffmpeg .temp.mp4
+_YTDL_PARTIAL_RE = re.compile(
+    r'^(?:\.f[\w-]+)?\.\w+\.(?:part(?:-Frag\d+)?|ytdl)$|^\.f[\w-]+\.\w+$|^\.temp\.\w+$'
+)
+
+
+def _remove_ytdl_partials(filenames: set[str]) -> None:
+    """Delete what an interrupted download of ``filenames`` left next to them."""
+    for filename in filenames:
+        folder, name = os.path.split(filename)
+        stem = re.sub(r'\.f[\w-]+$', '', os.path.splitext(name)[0])
+        try:
+            names = os.listdir(folder or '.')
+        except OSError:
+            continue
+        for other in names:
+            if other.startswith(stem) and _YTDL_PARTIAL_RE.match(other[len(stem):]):
+                try:
+                    os.remove(os.path.join(folder, other))
+                except OSError as e:
+                    logging.error('Не удалось удалить %s: %s', other, e)
+
+
+@dataclass(eq=False)
+class _YtdlWorker:
+    process: 'multiprocessing.Process'
+    conn: 'Connection'
+    cancelled: bool = False
+    # Файлы текущей задачи (из прогресса); после убийства их хвосты удаляются
+    outputs: set[str] = field(default_factory=set)
+
+    def kill(self) -> None:
+        _kill_process_tree(self.process)
+        self.process.join(5)
+        self.conn.close()
+        _remove_ytdl_partials(self.outputs)
+        self.outputs.clear()
+
+
+class YtdlProcessPool:
+    """Runs YouTube downloads (and their ffmpeg merges) in worker processes.
+
+    Each worker keeps its own :class:`YtdlEngine` between jobs.  A job that
+    exceeds its timeout, stops reporting progress or is cancelled has its
+    worker killed; a crashed worker only fails its own job.  Progress is sent
+    back over a pipe and fed to :data:`metrics` in the job's thread.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._idle: list[_YtdlWorker] = []
+        self._busy: set[_YtdlWorker] = set()
+        self.processes: Optional[int] = None
+        self.timeout = 0.0
+        self.stall_timeout = 0.0
+
+    def configure(self) -> None:
+        """Re-read ``[youtube]`` from config.ini."""
+        cfg = load_section('youtube', YOUTUBE_DEFAULTS)
+        with self._cond:
+            self.processes = max(0, cfg['processes'])
+            self.timeout = max(0.0, cfg['timeout'])
+            self.stall_timeout = max(0.0, cfg['stall_timeout'])
+            self._cond.notify_all()
+
+    @property
+    def enabled(self) -> bool:
+        if self.processes is None:
+            self.configure()
+        return bool(self.processes)
+
+    def _spawn(self) -> _YtdlWorker:
+        import multiprocessing
+        ctx = multiprocessing.get_context('spawn')
+        parent, child = ctx.Pipe()
+        process = ctx.Process(target=_ytdl_worker, args=(child,), name='ytdl-worker', daemon=True)
+        process.start()
+        child.close()
+        return _YtdlWorker(process, parent)
+
+    def _acquire(self) -> _YtdlWorker:
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._busy) < max(1, self.processes or 0))
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.process.is_alive():
+                    break
+                worker.kill()
+            else:
+                worker = self._spawn()
+            self._busy.add(worker)
+            return worker
+
+    def _release(self, worker: _YtdlWorker, healthy: bool) -> None:
+        with self._cond:
+            self._busy.discard(worker)
+            keep = healthy and len(self._idle) + len(self._busy) < (self.processes or 0)
+            if keep:
+                self._idle.append(worker)
+            self._cond.notify_all()
+        if not keep:
+            worker.kill()
+
+    def download(self, url: str, folder: str, profile: Optional[str] = None) -> list[str]:
+        """Download ``url`` into ``folder`` in a worker; ``[]`` on any failure."""
+        worker = self._acquire()
+        healthy = False
+        started = last = time.monotonic()
+        problem = ''
+        try:
+            worker.conn.send((url, folder, profile))
+            while True:
+                now = time.monotonic()
+                if self.timeout and now - started > self.timeout:
+                    problem = f"превышено время {self.timeout:.0f} с"
+                    break
+                if self.stall_timeout and now - last > self.stall_timeout:
+                    problem = f"нет прогресса {self.stall_timeout:.0f} с"
+                    break
+                if not worker.conn.poll(YTDL_POLL_INTERVAL):
+                    if not worker.process.is_alive():
+                        raise EOFError
+                    continue
+                kind, payload = worker.conn.recv()
+                last = time.monotonic()
+                if kind == 'progress':
+                    if payload.get('filename'):
+                        worker.outputs.add(payload['filename'])
+                    metrics.ytdl_hook(payload)
+                    continue
+                healthy = True
+                worker.outputs.clear()
+                return payload
+        except (EOFError, OSError):
+            if worker.cancelled:
+                problem = 'отменено'
+            else:
+                worker.process.join(1)
+                problem = f"процесс yt-dlp завершился аварийно (код {worker.process.exitcode})"
+        finally:
+            self._release(worker, healthy)
+        logging.error('YouTube %s: %s', url, problem)
+        print(f"Не удалось скачать {url}: {problem}")
+        return []
+
+    def cancel_all(self) -> int:
+        """Kill the workers of running jobs; those jobs fail and stay in the list."""
+        with self._cond:
+            busy = list(self._busy)
+            for worker in busy:
+                worker.cancelled = True
+        for worker in busy:
+            _kill_process_tree(worker.process)
+        return len(busy)
+
+    def close(self) -> None:
+        """Stop the idle workers; the next job starts new ones."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(5)
+            worker.kill()
+
+
+ytdl_pool = YtdlProcessPool()
+
+
+# === Асинхронный движок для картинок ===
+# Одновременных запросов к одному хосту и всего; остальные ждут в цикле
+# событий, не занимая поток. Предел на хост — host_connections в [images]
+ASYNC_HOST_CONNECTIONS = 16
+ASYNC_MAX_CONNECTIONS = 512
+# Потоки для записи файлов (и для запросов, если aiohttp не установлен)
+ASYNC_IO_WORKERS = 8
+ASYNC_WRITE_BUFFER = 256 * 1024
+
+
+class HttpStatusError(Exception):
+    """The server answered with an HTTP error status."""
+
+    def __init__(self, status: int, url: str) -> None:
+        super().__init__(f"HTTP {status}: {url}")
+        self.status = status
+
+
+class AsyncImageEngine:
+    """One asyncio loop that carries the WB and Pinterest traffic of a batch.
+
+    The loop runs in a background thread; the synchronous downloaders hand
+    it coroutines through :meth:`run` and only their own job thread waits.
+    Requests go through ``aiohttp`` behind a semaphore per host, and files
+    are written in a small thread pool.  Without ``aiohttp`` the same
+    coroutines call :data:`http_client` in that pool instead.  Host rate
+    limits, retries and per-host statistics are shared with
+    :data:`http_client`.
+    """
+
+    def __init__(
+        self,
+        host_limit: int = ASYNC_HOST_CONNECTIONS,
+        total_limit: int = ASYNC_MAX_CONNECTIONS,
+        io_workers: int = ASYNC_IO_WORKERS,
+    ) -> None:
+        self.host_limit = max(1, host_limit)
+        self.total_limit = max(1, total_limit)
+        self.io_workers = max(1, io_workers)
+        self.use_aiohttp = importlib.util.find_spec('aiohttp') is not None
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._io: Optional[ThreadPoolExecutor] = None
+        # Создаются и используются только в потоке цикла
+        self._session: Optional['aiohttp.ClientSession'] = None
+        self._hosts: dict[str, asyncio.Semaphore] = {}
+
+    def configure(self) -> None:
+        """Re-read ``host_connections`` of ``[images]`` from config.ini."""
+        limit = max(1, load_section('images', IMAGES_DEFAULTS)['host_connections'])
+        if limit == self.host_limit:
+            return
+        with self._lock:
+            started = self._loop is not None
+        if started:
+            # Семафоры и пул соединений принадлежат циклу — меняются в нём
+            self.run(self._set_host_limit(limit))
+        else:
+            self.host_limit = limit
+
+    async def _set_host_limit(self, limit: int) -> None:
+        self.host_limit = limit
+        self._hosts.clear()
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()
+
+    def _start(self) -> 'asyncio.AbstractEventLoop':
+        import asyncio
+        with self._lock:
+            if self._loop is None:
+                self._io = ThreadPoolExecutor(self.io_workers, thread_name_prefix='img-io')
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='img-loop', daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def run(self, coro):
+        """Run ``coro`` in the engine loop and return its result (any thread)."""
+        import asyncio
+        job = _current_job.get()
+
+        async def in_job():
+            # Задачи цикла не видят контекст вызывающего потока
+            _current_job.set(job)
+            return await coro
+
+        return asyncio.run_coroutine_threadsafe(in_job(), self._start()).result()
+
+    async def call(self, fn: Callable, *args, **kwargs):
+        """Run blocking ``fn`` in the I/O pool, keeping the current job context."""
+        import asyncio
+        ctx = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._io, functools.partial(ctx.run, fn, *args, **kwargs)
+        )
+
+    def _slot(self, url: str) -> 'asyncio.Semaphore':
+        import asyncio
+        host = http_client._host(url)
+        sem = self._hosts.get(host)
+        if sem is None:
+            sem = self._hosts[host] = asyncio.Semaphore(self.host_limit)
+        return sem
+
+    async def _client(self) -> 'aiohttp.ClientSession':
+        if self._session is None:
+            import aiohttp
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.total_limit, limit_per_host=self.host_limit
+                ),
+                headers={'User-Agent': HTTP_USER_AGENT},
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=HTTP_TIMEOUT[0], sock_read=HTTP_TIMEOUT[1]
+                ),
+            )
+        return self._session
+
+    @staticmethod
+    async def _transferred(n: int) -> None:
+        import asyncio
+        metrics.add_bytes(n)
+        jm = _current_job.get()
+        wait = bandwidth.reserve(n, jm.site if jm is not None else None)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    @asynccontextmanager
+    async def _get(
+        self, url: str, timeout: Optional[float] = None, retry: bool = True,
+        headers: Optional[dict] = None,
+    ):
+        """Yield the ``aiohttp`` response of ``url``, retrying like :meth:`HttpClient.request`."""
+        import asyncio
+        import aiohttp
+        session = await self._client()
+        host = http_client._host(url)
+        attempts = http_client.retries + 1 if retry else 1
+        for attempt in range(attempts):
+            wait = http_client._reserve(host)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            resp = None
+            async with self._slot(url):
+                started = time.monotonic()
+                try:
+                    # Без своего предела действуют sock_connect/sock_read сессии;
+                    # timeout=None отключил бы их совсем
+                    resp = await session.get(
+                        url, headers=headers,
+                        **({'timeout': aiohttp.ClientTimeout(
+                            total=timeout, sock_connect=HTTP_TIMEOUT[0], sock_read=HTTP_TIMEOUT[1]
+                        )} if timeout else {}),
+                    )
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    http_client._observe(host, time.monotonic() - started, error=True)
+                    if attempt + 1 >= attempts:
+                        raise
+                else:
+                    http_client._observe(host, time.monotonic() - started)
+                if resp is not None:
+                    if resp.status not in HTTP_RETRY_STATUSES or attempt + 1 >= attempts:
+                        try:
+                            yield resp
+                        finally:
+                            resp.release()
+                        return
+                    resp.release()
+            http_client._retried(host)
+            await asyncio.sleep(http_client._delay(attempt, resp))
+
+    async def get(
+        self, url: str, timeout: Optional[float] = None, retry: bool = True,
+        headers: Optional[dict] = None,
+    ) -> tuple[int, bytes, dict[str, str]]:
+        """Return ``(status, body, headers)`` of ``url``; header names are lowercase."""
+        if not self.use_aiohttp:
+            async with self._slot(url):
+                resp = await self.call(
+                    http_client.get, url, retry=retry, headers=headers,
+                    **({'timeout': timeout} if timeout else {})
+                )
+            return resp.status_code, resp.content, {k.lower(): v for k, v in resp.headers.items()}
+        async with self._get(url, timeout, retry, headers) as resp:
+            body = await resp.read()
+            received = {k.lower(): v for k, v in resp.headers.items()}
+        http_client.count_bytes(url, len(body))
+        await self._transferred(len(body))
+        return resp.status, body, received
+
+    async def fetch(
+        self, url: str, timeout: Optional[float] = None, retry: bool = True
+    ) -> tuple[int, bytes]:
+        """Return ``(status, body)`` of ``url``."""
+        status, body, _ = await self.get(url, timeout, retry)
+        return status, body
+
+    async def stream(self, url: str, feed: Callable[[bytes], bool]) -> int:
+        """Pass the body of ``url`` to ``feed`` chunk by chunk until it returns true."""
+        if not self.use_aiohttp:
+            async with self._slot(url):
+                return await self.call(self._stream_sync, url, feed)
+        read = 0
+        async with self._get(url) as resp:
+            if resp.status >= 400:
+                raise HttpStatusError(resp.status, url)
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                read += len(chunk)
+                await self._transferred(len(chunk))
+                if feed(chunk):
+                    break
+        http_client.count_bytes(url, read)
+        return read
+
+    @staticmethod
+    def _stream_sync(url: str, feed: Callable[[bytes], bool]) -> int:
+        read = 0
+        with http_client.get(url, stream=True) as resp:
+            if resp.status_code >= 400:
+                raise HttpStatusError(resp.status_code, url)
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                read += len(chunk)
+                transferred(len(chunk))
+                if feed(chunk):
+                    break
+        http_client.count_bytes(url, read)
+        return read
+
+    async def download(
+        self, url: str, path: str, timeout: Optional[float] = None,
+        headers: Optional[dict] = None, hasher=None,
+    ) -> Optional[int]:
+        """Save ``url`` to ``path`` through a ``.part`` file; return the bytes written.
+
+        Raises :class:`HttpStatusError` when the server answers with an error.
+        ``None`` means a conditional request got ``304`` and ``path`` is unchanged.
+        ``hasher`` (a :class:`StreamHash`) is fed with the body as it arrives.
+
+        Large files that accept ranges, and interrupted segmented downloads,
+        go through :meth:`HttpClient.download` to get :class:`SegmentedDownload`.
+        """
+        if not self.use_aiohttp or await self.call(os.path.exists, f"{path}.part.json"):
+            # Прерванная докачка по частям продолжается тем же путём
+            async with self._slot(url):
+                return await self.call(self._download_sync, url, path, timeout, headers, hasher)
+        written = 0
+        if hasher is not None:
+            hasher.reset()
+        async with self._get(url, timeout, headers=headers) as resp:
+            if resp.status == 304:
+                return None
+            if resp.status >= 400:
+                raise HttpStatusError(resp.status, url)
+            segmented = self._segmentable(resp)
+            if not segmented:
+                written = await self._save_body(resp, path, hasher)
+        if segmented:
+            # Ответ закрыт непрочитанным: тело придёт диапазонами по нескольким соединениям
+            async with self._slot(url):
+                return await self.call(self._download_sync, url, path, timeout, headers, hasher)
+        http_client.count_bytes(url, written)
+        return written
+
+    @staticmethod
+    def _segmentable(resp: 'aiohttp.ClientResponse') -> bool:
+        """Whether the body of ``resp`` is worth a :class:`SegmentedDownload`."""
+        return (
+            SEGMENT_CONNECTIONS > 1
+            and (resp.content_length or 0) >= SEGMENT_MIN_SIZE
+            and resp.headers.get('Accept-Ranges', '').lower() == 'bytes'
+            and resp.headers.get('Content-Encoding', 'identity').lower() == 'identity'
+        )
+
+    async def _save_body(
+        self, resp: 'aiohttp.ClientResponse', path: str, hasher: Optional[StreamHash]
+    ) -> int:
+        tmp = f"{path}.part"
+        written = 0
+        f = await self.call(open, tmp, 'wb')
+        try:
+            buf = bytearray()
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                buf += chunk
+                if hasher is not None:
+                    hasher.update(chunk)
+                written += len(chunk)
+                await self._transferred(len(chunk))
+                if len(buf) >= ASYNC_WRITE_BUFFER:
+                    await self.call(f.write, bytes(buf))
+                    buf.clear()
+            if buf:
+                await self.call(f.write, bytes(buf))
+            await self.call(f.close)
+            await self.call(os.replace, tmp, path)
+        except BaseException:
+            await self.call(self._discard, f, tmp)
+            raise
+        return written
+
+    @staticmethod
+    def _download_sync(
+        url: str, path: str, timeout: Optional[float], headers: Optional[dict] = None,
+        hasher=None,
+    ) -> Optional[int]:
+        import requests
+        try:
+            return http_client.download(
+                url, path, headers=headers, hasher=hasher,
+                **({'timeout': timeout} if timeout else {})
+            )
+        except requests.HTTPError as e:
+            if e.response is None:
+                raise
+            raise HttpStatusError(e.response.status_code, url) from e
+
+    @staticmethod
+    def network_errors() -> tuple[type[BaseException], ...]:
+        """Exceptions of a failed request in either mode (other than :class:`HttpStatusError`)."""
+        import asyncio
+        import requests
+        errors: tuple[type[BaseException], ...] = (requests.RequestException, asyncio.TimeoutError, OSError)
+        if importlib.util.find_spec('aiohttp') is not None:
+            import aiohttp
+            errors += (aiohttp.ClientError,)
+        return errors
+
+    @staticmethod
+    def _discard(f, tmp: str) -> None:
+        f.close()
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+image_engine = AsyncImageEngine()
+
+
+# === Хранилище по содержимому ===
+# [store] в config.ini: enabled = true — картинки лежат один раз по SHA-256 в
+# path (по умолчанию Downloads/.store), а в обычных папках остаются жёсткие
+# ссылки на них (или символические, если жёсткие невозможны)
+STORE_DEFAULTS = {
+    'enabled': False,
+    'path': '',
+}
+STORE_DIRNAME = '.store'
+
+
+class ContentStore:
+    """Optional content-addressed store of downloaded images.
+
+    A finished file is kept as ``<root>/<ab>/<sha256>`` and the usual path
+    becomes a link to it, so the same photo of several WB colour variants or
+    Pinterest pins takes space once.  A re-downloaded file replaces its link
+    with a new inode and never changes the stored copy in place.
+    """
+
+    def __init__(self) -> None:
+        self._enabled: Optional[bool] = None
+        self.root = ''
+
+    def configure(self) -> None:
+        """Re-read ``[store]`` from config.ini."""
+        cfg = load_section('store', STORE_DEFAULTS)
+        self.root = os.path.abspath(cfg['path'] or os.path.join(DOWNLOADS_FOLDER, STORE_DIRNAME))
+        self._enabled = cfg['enabled']
+
+    @property
+    def enabled(self) -> bool:
+        if self._enabled is None:
+            self.configure()
+        return bool(self._enabled)
+
+    def hasher(self) -> Optional[StreamHash]:
+        """Hash to feed while downloading, ``None`` when the store is off."""
+        return StreamHash() if self.enabled else None
+
+    def blob(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    @staticmethod
+    def _link(blob: str, path: str) -> None:
+        tmp = f"{path}.link"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            os.symlink(blob, tmp)
+        os.replace(tmp, path)
+
+    def adopt(self, path: str, hasher=None) -> None:
+        """Store the finished file ``path`` by content and link it back.
+
+        ``hasher`` is the :meth:`hasher` fed during the download; without it
+        the file is read once more.  Errors are logged, the file stays as is.
+        """
+        if not self.enabled:
+            return
+        try:
+            if hasher is None:
+                hasher = StreamHash()
+                _hash_file(path, hasher)
+            blob = self.blob(hasher.hexdigest())
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            if not os.path.exists(blob):
+                try:
+                    os.link(path, blob)
+                    return
+                except FileExistsError:
+                    pass
+                except OSError:
+                    # Другой диск или ФС без жёстких ссылок: копия в хранилище, здесь — ссылка
+                    shutil.copy2(path, f"{blob}.tmp")
+                    os.replace(f"{blob}.tmp", blob)
+            if not os.path.samefile(blob, path):
+                self._link(blob, path)
+        except OSError as e:
+            logging.error('Хранилище: не удалось сохранить %s: %s', path, e)
+
+    def maintain(self, collect: bool = False) -> dict[str, int]:
+        """Count the stored files and the space the links save.
+
+        Stored files nothing links to any more are orphans; with ``collect``
+        they are deleted.
+        """
+        # Жёсткие ссылки видны по st_nlink, символические приходится искать
+        symlinked: defaultdict[str, int] = defaultdict(int)
+        broken = 0
+        for dirpath, dirnames, filenames in os.walk(DOWNLOADS_FOLDER):
+            dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) != self.root]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if os.path.islink(path):
+                    target = os.path.realpath(path)
+                    if os.path.exists(target):
+                        symlinked[target] += 1
+                    else:
+                        broken += 1
+        stats = dict.fromkeys(('files', 'size', 'links', 'saved', 'orphans', 'orphan_size'), 0)
+        stats['broken'] = broken
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                blob = os.path.join(dirpath, name)
+                st = os.stat(blob)
+                links = st.st_nlink - 1 + symlinked.get(os.path.realpath(blob), 0)
+                if links <= 0 or name.endswith('.tmp'):
+                    stats['orphans'] += 1
+                    stats['orphan_size'] += st.st_size
+                    if collect:
+                        os.remove(blob)
+                    continue
+                stats['files'] += 1
+                stats['size'] += st.st_size
+                stats['links'] += links
+                stats['saved'] += st.st_size * (links - 1)
+        return stats
+
+
+content_store = ContentStore()
+
+
+# === Обработка картинок ===
+# [images] в config.ini: enabled = true — скачанные картинки WB и Pinterest
+# обрабатываются в отдельных процессах, пока идут остальные загрузки.
+# format — jpeg, png, webp или пусто (формат не меняется), max_size — предел
+# длинной стороны, thumbnail — длинная сторона превью в папке thumbs (0 — без
+# превью), strip_metadata — убрать EXIF, processes = 0 — один поток в этом процессе.
+# host_connections — запросов в полёте на один хост WB/Pinterest (действует всегда)
+IMAGES_DEFAULTS = {
+    'enabled': False,
+    'format': 'jpeg',
+    'quality': 90,
+    'max_size': 0,
+    'thumbnail': 0,
+    'strip_metadata': True,
+    'processes': min(4, os.cpu_count() or 1),
+    'host_connections': ASYNC_HOST_CONNECTIONS,
+}
+# Первое расширение — для новых файлов
+IMAGE_EXTENSIONS = {'JPEG': ('.jpg', '.jpeg'), 'PNG': ('.png',), 'WEBP': ('.webp',)}
+THUMBS_DIRNAME = 'thumbs'
+_METADATA_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment', 'photoshop')
+
+
+@dataclass(frozen=True)
+class ImageSettings:
+    """What :func:`process_image` does to a file; passed to the worker processes."""
+
+    format: str
+    quality: int
+    max_size: int
+    thumbnail: int
+    strip_metadata: bool
+
+    @classmethod
+    def from_config(cls, cfg: dict) -> 'ImageSettings':
+        fmt = cfg['format'].strip().upper()
+        fmt = 'JPEG' if fmt == 'JPG' else fmt
+        if fmt and fmt not in IMAGE_EXTENSIONS:
+            logging.error('Неверное значение images.format = %r', cfg['format'])
+            fmt = ''
+        return cls(
+            fmt,
+            min(100, max(1, cfg['quality'])),
+            max(0, cfg['max_size']),
+            max(0, cfg['thumbnail']),
+            cfg['strip_metadata'],
+        )
+
+
+def _convert_for(im: 'Image.Image', fmt: str) -> 'Image.Image':
+    """Convert ``im`` to a mode ``fmt`` can store; JPEG gets a white background."""
+    from PIL import Image
+    alpha = im.mode in ('RGBA', 'LA', 'PA') or 'transparency' in im.info
+    if fmt == 'JPEG':
+        if im.mode in ('RGB', 'L'):
+            return im
+        if not alpha:
+            return im.convert('RGB')
+        rgba = im.convert('RGBA')
+        flat = Image.new('RGB', rgba.size, (255, 255, 255))
+        flat.paste(rgba, mask=rgba.getchannel('A'))
+        return flat
+    if fmt == 'PNG' and im.mode in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I'):
+        return im
+    if fmt == 'WEBP' and im.mode in ('RGB', 'RGBA'):
+        return im
+    return im.convert('RGBA' if alpha else 'RGB')
+
+
+def _save_image(im: 'Image.Image', path: str, fmt: str, settings: ImageSettings, info: dict) -> None:
+    im = _convert_for(im, fmt)
+    kwargs = {}
+    if fmt in ('JPEG', 'WEBP'):
+        kwargs['quality'] = settings.quality
+    if fmt in ('JPEG', 'PNG'):
+        kwargs['optimize'] = True
+    if info.get('icc_profile'):
+        kwargs['icc_profile'] = info['icc_profile']
+    if not settings.strip_metadata and info.get('exif'):
+        kwargs['exif'] = info['exif']
+    tmp = f"{path}.tmp"
+    try:
+        im.save(tmp, fmt, **kwargs)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def process_image(path: str, settings: ImageSettings) -> list[str]:
+    """Convert, shrink and thumbnail one downloaded image.
+
+    The result goes next to ``path`` with the extension of the target format;
+    when that is ``path`` itself the file is replaced (keeping its mtime) only
+    if something changes.  Animated images are left alone.  Returns the files
+    written.
+    """
+    from PIL import Image, ImageOps
+    with Image.open(path) as src:
+        if getattr(src, 'is_animated', False):
+            return []
+        fmt = settings.format or src.format
+        if fmt not in IMAGE_EXTENSIONS:
+            fmt = 'JPEG'
+        rotated = src.getexif().get(0x0112, 1) != 1
+        im = ImageOps.exif_transpose(src)
+        info = dict(im.info)
+        metadata = any(key in src.info for key in _METADATA_KEYS)
+    resized = bool(settings.max_size) and max(im.size) > settings.max_size
+    if resized:
+        im.thumbnail((settings.max_size, settings.max_size), Image.LANCZOS)
+
+    base, ext = os.path.splitext(path)
+    out = path if ext.lower() in IMAGE_EXTENSIONS[fmt] else base + IMAGE_EXTENSIONS[fmt][0]
+    written = []
+    if out != path or resized or rotated or (settings.strip_metadata and metadata):
+        st = os.stat(path)
+        _save_image(im, out, fmt, settings, info)
+        # По mtime WB перепроверяет картинку через If-Modified-Since
+        os.utime(out, (st.st_atime, st.st_mtime))
+        written.append(out)
+    if settings.thumbnail:
+        thumb = im.copy()
+        thumb.thumbnail((settings.thumbnail, settings.thumbnail), Image.LANCZOS)
+        folder = os.path.join(os.path.dirname(path), THUMBS_DIRNAME)
+        os.makedirs(folder, exist_ok=True)
+        thumb_path = os.path.join(folder, os.path.basename(out))
+        _save_image(thumb, thumb_path, fmt, settings, info)
+        written.append(thumb_path)
+    return written
+
+
+def _ignore_sigint() -> None:
+    # Ctrl+C получает вся группа процессов; решает родитель
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class ImageProcessor:
+    """Post-processing stage for downloaded images (see :func:`process_image`).
+
+    :meth:`submit` only queues the file, so the download that produced it
+    goes on at once and the conversions overlap with the rest of the batch.
+    :func:`run_batch` waits for the queue in :meth:`close` before its report.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pool = None
+        self.processes: Optional[int] = None
+        self.settings: Optional[ImageSettings] = None
+
+    def configure(self) -> None:
+        """Re-read ``[images]`` from config.ini."""
+        cfg = load_section('images', IMAGES_DEFAULTS)
+        with self._lock:
+            self.processes = max(0, cfg['processes'])
+            self.settings = ImageSettings.from_config(cfg) if cfg['enabled'] else None
+
+    @property
+    def enabled(self) -> bool:
+        if self.processes is None:
+            self.configure()
+        return self.settings is not None
+
+    def _start(self):
+        if self.processes:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            return ProcessPoolExecutor(
+                self.processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_ignore_sigint,
+            )
+        return ThreadPoolExecutor(1, thread_name_prefix='images')
+
+    def submit(self, path: str) -> None:
+        """Queue ``path`` for processing; does nothing when ``[images]`` is off."""
+        if not self.enabled:
+            return
+        with self._lock:
+            for _ in range(2):
+                if self._pool is None:
+                    self._pool = self._start()
+                try:
+                    future = self._pool.submit(process_image, path, self.settings)
+                    break
+                except RuntimeError:
+                    # Пул сломан упавшим процессом: заводим новый
+                    self._pool = None
+            else:
+                logging.error('Обработка картинок: не удалось поставить %s', path)
+                metrics.add_image(None)
+                return
+        future.add_done_callback(functools.partial(self._done, path))
+
+    @staticmethod
+    def _done(path: str, future) -> None:
+        try:
+            files = future.result()
+        except Exception as e:
+            logging.error('Не удалось обработать %s: %s', path, e)
+            metrics.add_image(None)
+            return
+        for out in files:
+            content_store.adopt(out)
+        metrics.add_image(len(files))
+
+    def close(self) -> None:
+        """Wait for the queued images and stop the workers."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+
+image_processor = ImageProcessor()
+
+
+def finish_image(path: str, hasher=None) -> None:
+    """Hand a freshly downloaded image to the content store and the post-processing."""
+    content_store.adopt(path, hasher)
+    image_processor.submit(path)
+
+
+# === Pinterest ===
+# Страница читается потоково и не дальше этого предела
+PINTEREST_MAX_PAGE = 8 * 1024 * 1024
+_PAGE_OVERLAP = 4096
+PINIMG_URL = "https://i.pinimg.com"
+_PINIMG_RE = re.compile(
+    r'https?://i\.pinimg\.com/[^/"\'\s]+/((?:[0-9a-f]{2}/){3}([0-9a-f]+)\.(\w+))'
+)
+_OG_IMAGE_RE = re.compile(r'<meta\b[^>]*["\']og:image["\'][^>]*>', re.IGNORECASE)
+_META_CONTENT_RE = re.compile(r'\bcontent="([^"]+)"')
+_ORIG_RE = re.compile(r'"orig"\s*:\s*\{[^{}]*?"url"\s*:\s*"([^"]+)"')
+
+
+def _unescape_json_url(text: str) -> str:
+    return text.replace('\\/', '/').replace('\\u002F', '/').replace('&amp;', '&')
+
+
+class PinterestPage:
+    """Incremental scanner of a Pinterest page that never builds a DOM.
+
+    Collects the ``og:image`` of the page and ``{image hash: original URL}``
+    taken from the embedded JSON (``"orig": {"url": ...}``).  For a single
+    pin :meth:`feed` reports completion as soon as the original of the
+    ``og:image`` is known.
+    """
+
+    def __init__(self, board: bool = False) -> None:
+        self.board = board
+        self.og_image: Optional[str] = None
+        self.originals: dict[str, str] = {}
+        self.read = 0
+        self._tail = ''
+
+    def feed(self, chunk: bytes) -> bool:
+        """Scan the next chunk; return ``True`` when reading can stop."""
+        self.read += len(chunk)
+        window = self._tail + chunk.decode('utf-8', errors='ignore')
+        self._tail = window[-_PAGE_OVERLAP:]
+        window = _unescape_json_url(window)
+        if self.og_image is None:
+            m = _OG_IMAGE_RE.search(window)
+            content = _META_CONTENT_RE.search(m.group(0)) if m else None
+            if content:
+                self.og_image = content.group(1)
+        for m in _ORIG_RE.finditer(window):
+            img = _PINIMG_RE.match(m.group(1))
+            if img:
+                self.originals.setdefault(img.group(2), m.group(1))
+        if not self.board and self.og_image:
+            og = _PINIMG_RE.match(self.og_image)
+            if og and og.group(2) in self.originals:
+                return True
+        return self.read >= PINTEREST_MAX_PAGE
+
+
+async def scan_pinterest_page_async(
+    url: str, board: bool = False
+) -> tuple[Optional[str], dict[str, str]]:
+    """Return the ``og:image`` and the originals of a page (see :class:`PinterestPage`)."""
+    page = PinterestPage(board)
+    await image_engine.stream(url, page.feed)
+    return page.og_image, page.originals
+
+
+def scan_pinterest_page(url: str, board: bool = False) -> tuple[Optional[str], dict[str, str]]:
+    """Synchronous wrapper of :func:`scan_pinterest_page_async`."""
+    return image_engine.run(scan_pinterest_page_async(url, board))
+
+
+def _original_candidates(img_url: str, originals: dict[str, str]) -> list[str]:
+    """Full-size URLs for ``img_url``, best first, ending with ``img_url`` itself."""
+    candidates = []
+    m = _PINIMG_RE.match(img_url)
+    if m:
+        if m.group(2) in originals:
+            candidates.append(originals[m.group(2)])
+        candidates.append(f"{PINIMG_URL}/originals/{m.group(1)}")
+    candidates.append(img_url)
+    return list(dict.fromkeys(candidates))
+
+
+async def _download_first(candidates: list[str], path_for: Callable[[str], str]) -> Optional[str]:
+    for img_url in candidates:
+        path = path_for(img_url)
+        try:
+            hasher = content_store.hasher()
+            await image_engine.download(img_url, path, hasher=hasher)
+            await image_engine.call(finish_image, path, hasher)
+            return path
+        except HttpStatusError as e:
+            logging.info('Pinterest: %s недоступен (%s)', img_url, e)
+        except image_engine.network_errors() as e:
+            # Сбой сети не должен ронять всю доску в gather
+            logging.error('Pinterest: не удалось скачать %s: %s', img_url, e)
+            return None
+    return None
+
+
+# Первые сегменты пути, которые не имя пользователя
+_PINTEREST_RESERVED = frozenset({
+    'pin', 'search', 'ideas', 'today', 'explore', 'business', 'settings',
+    'categories', 'topics', 'videos', 'shopping', 'news_hub',
+})
+
+
+def pinterest_board(url: str) -> Optional[tuple[str, str]]:
+    """``(user, board)`` of a ``/<user>/<board>/`` URL, ``None`` for other pages."""
+    parts = [p for p in urlparse(url).path.split('/') if p]
+    if (
+        len(parts) == 2
+        and parts[0].lower() not in _PINTEREST_RESERVED
+        # /<user>/_saved/, /<user>/_created/ — вкладки профиля, не доски
+        and not parts[1].startswith('_')
+    ):
+        return parts[0], parts[1]
+    return None
+
+
+async def download_pinterest_image_async(url: str, folder: str) -> list[str]:
+    """Скачивает изображение пина в исходном размере или все пины доски."""
+    import asyncio
+    try:
+        pin = PIN_ID_RE.search(url)
+        board = None if pin else pinterest_board(url)
+        if not pin and not board:
+            print("Это не пин и не доска Pinterest: скачиваются только они.")
+            return []
+        og_image, originals = await scan_pinterest_page_async(url, board=board is not None)
+
+        if pin:
+            if not og_image and not originals:
+                print("Не удалось найти изображение на странице Pinterest.")
+                return []
+            candidates = _original_candidates(
+                og_image or next(iter(originals.values())), originals
+            )
+            print(f"Скачиваем изображение: {candidates[0]}")
+            filename = await _download_first(
+                candidates,
+                lambda u: os.path.join(
+                    folder, f"{pin.group(1)}_{os.path.basename(u.split('?')[0])}"
+                ),
+            )
+            if filename:
+                print(f"Изображение сохранено как: {filename}")
+                return [filename]
+            print("Не удалось скачать изображение Pinterest.")
+            return []
+
+        # Доска: все оригиналы из встроенного JSON
+        if not originals:
+            print("Не удалось найти изображения на доске Pinterest.")
+            return []
+        board_name = "".join(c for c in " - ".join(board) if c not in "\\/:*?\"<>|")
+        board_folder = os.path.join(folder, board_name or 'board')
+        await image_engine.call(os.makedirs, board_folder, exist_ok=True)
+        print(f"Доска Pinterest: найдено изображений {len(originals)}")
+
+        # Все пины запрашиваются сразу; в полёте их держит семафор хоста
+        results = await asyncio.gather(*(
+            _download_first(
+                _original_candidates(img_url, originals),
+                lambda u: os.path.join(board_folder, os.path.basename(u.split('?')[0])),
+            )
+            for img_url in originals.values()
+        ))
+        saved = [p for p in results if p]
+        print(f"Сохранено изображений с доски: {len(saved)}")
+        return saved if len(saved) == len(results) else PartialFiles(saved)
+    except Exception as e:
+        logging.error('Ошибка при скачивании изображения с Pinterest: %s', e)
+        print(f"Ошибка при скачивании изображения с Pinterest: {e}")
+    return []
+
+
+def download_pinterest_image(url, folder):
+    """Скачивает изображение пина или доски через :data:`image_engine`."""
+    return image_engine.run(download_pinterest_image_async(url, folder))
+
+
+# === Wildberries: кеш карточек ===
+# [wb] в config.ini: card_ttl — сколько секунд карточка считается свежей без
+# запроса; max_cards — сколько карточек хранить (давно не нужные удаляются)
+WB_CACHE_DEFAULTS = {
+    'card_ttl': 6 * 3600.0,
+    'max_cards': 20000,
+}
+
+
+@dataclass
+class WBCard:
+    """``card.json`` of a WB product with the host and validators it came with."""
+
+    product_id: int
+    host: int
+    data: dict
+    etag: str = ''
+    last_modified: str = ''
+    checked: float = field(default_factory=time.time)
+
+    @classmethod
+    def from_response(cls, product_id: int, host: int, body: bytes, headers: dict) -> 'WBCard':
+        return cls(
+            product_id, host, json.loads(body),
+            headers.get('etag', ''), headers.get('last-modified', ''),
+        )
+
+    def fresh(self, ttl: float) -> bool:
+        return time.time() - self.checked < ttl
+
+    def validators(self) -> dict[str, str]:
+        """Headers of a conditional request for this card."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class WBCardCache:
+    """LRU store of :class:`WBCard` in SQLite (:data:`WB_CARDS_FILE`).
+
+    The database is opened lazily.  ``used`` is bumped on every read, and
+    :meth:`put` drops the least recently used cards beyond ``max_cards``.
+    """
+
+    def __init__(self, path: str = WB_CARDS_FILE) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._size = 0
+        self.ttl: Optional[float] = None
+        self.max_cards = WB_CACHE_DEFAULTS['max_cards']
+
+    def configure(self) -> None:
+        """Re-read ``[wb]`` from config.ini; :func:`run_batch` calls it once per batch."""
+        cfg = load_section('wb', WB_CACHE_DEFAULTS)
+        self.ttl, self.max_cards = cfg['card_ttl'], cfg['max_cards']
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS cards ('
+                ' product_id INTEGER PRIMARY KEY, host INTEGER NOT NULL, card TEXT NOT NULL,'
+                ' etag TEXT NOT NULL, last_modified TEXT NOT NULL,'
+                ' checked REAL NOT NULL, used REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS cards_used ON cards (used)')
+            self._size = self._db.execute('SELECT COUNT(*) FROM cards').fetchone()[0]
+        return self._db
+
+    def get(self, product_id: int) -> Optional[WBCard]:
+        with self._lock:
+            db = self._conn()
+            row = db.execute(
+                'SELECT host, card, etag, last_modified, checked FROM cards WHERE product_id = ?',
+                (product_id,),
+            ).fetchone()
+            if not row:
+                return None
+            db.execute('UPDATE cards SET used = ? WHERE product_id = ?', (time.time(), product_id))
+        host, card, etag, last_modified, checked = row
+        return WBCard(product_id, host, json.loads(card), etag, last_modified, checked)
+
+    def put(self, card: WBCard) -> None:
+        values = (
+            card.host, json.dumps(card.data, ensure_ascii=False), card.etag,
+            card.last_modified, card.checked, time.time(), card.product_id,
+        )
+        with self._lock:
+            db = self._conn()
+            updated = db.execute(
+                'UPDATE cards SET host = ?, card = ?, etag = ?, last_modified = ?,'
+                ' checked = ?, used = ? WHERE product_id = ?', values,
+            ).rowcount
+            if not updated:
+                db.execute('INSERT INTO cards (host, card, etag, last_modified, checked, used,'
+                           ' product_id) VALUES (?, ?, ?, ?, ?, ?, ?)', values)
+                self._size += 1
+            max_cards = max(1, self.max_cards)
+            if self._size > max_cards:
+                db.execute(
+                    'DELETE FROM cards WHERE product_id IN'
+                    ' (SELECT product_id FROM cards ORDER BY used LIMIT ?)',
+                    (self._size - max_cards,),
+                )
+                self._size = max_cards
+
+
+wb_card_cache = WBCardCache()
+
+
+# === Wildberries: поиск basket-хоста ===
+WB_BASKET_URL = "https://basket-{host:02d}.wbbasket.ru"
+WB_BASKET_HOSTS = 100
+WB_PROBE_WORKERS = 8
+WB_PROBE_TIMEOUT = 5
+
+
+class BasketResolver:
+    """Learns which ``basket-NN`` host serves a given ``vol`` range.
+
+    WB shards products by ``vol = id // 100000`` and hosts grow monotonically
+    with ``vol``, so two known points with the same host pin down every volume
+    between them.  The table is persisted as ``[first_vol, last_vol, host]``
+    ranges in :data:`WB_BASKETS_FILE`.
+    """
+
+    def __init__(self, path: str = WB_BASKETS_FILE, workers: int = WB_PROBE_WORKERS) -> None:
+        self.path = path
+        self.workers = max(1, workers)
+        self._lock = threading.Lock()
+        self._vols: list[int] = []
+        self._hosts: dict[int, int] = {}
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                ranges = json.load(f).get('ranges', [])
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.error('Не удалось прочитать таблицу basket-хостов: %s', e)
+            return
+        for first, last, host in ranges:
+            self._hosts[int(first)] = int(host)
+            self._hosts[int(last)] = int(host)
+        self._vols = sorted(self._hosts)
+
+    def _save(self) -> None:
+        ranges: list[list[int]] = []
+        for vol in self._vols:
+            host = self._hosts[vol]
+            if ranges and ranges[-1][2] == host:
+                ranges[-1][1] = vol
+            else:
+                ranges.append([vol, vol, host])
+        try:
+            atomic_write_text(self.path, json.dumps({'ranges': ranges}))
+        except Exception as e:
+            logging.error('Не удалось сохранить таблицу basket-хостов: %s', e)
+
+    def candidates(self, vol: int) -> list[int]:
+        """Return hosts ordered by how likely they are to serve ``vol``."""
+        with self._lock:
+            if vol in self._hosts:
+                predicted = lo_host = hi_host = self._hosts[vol]
+            else:
+                i = bisect.bisect_left(self._vols, vol)
+                lo_host = self._hosts[self._vols[i - 1]] if i > 0 else 0
+                hi_host = (
+                    self._hosts[self._vols[i]] if i < len(self._vols) else WB_BASKET_HOSTS - 1
+                )
+                predicted = lo_host if i > 0 else hi_host if self._vols else 0
+        return sorted(
+            range(WB_BASKET_HOSTS),
+            key=lambda h: (not lo_host <= h <= hi_host, abs(h - predicted), h),
+        )
+
+    def learn(self, vol: int, host: int) -> None:
+        """Record that ``vol`` lives on ``host`` and persist the table."""
+        with self._lock:
+            if self._hosts.get(vol) == host:
+                return
+            if vol not in self._hosts:
+                bisect.insort(self._vols, vol)
+            self._hosts[vol] = host
+            # Точки внутри диапазона с одинаковым хостом ничего не добавляют
+            i = self._vols.index(vol)
+            for j in (i + 1, i, i - 1):
+                if 0 < j < len(self._vols) - 1:
+                    left, mid, right = self._vols[j - 1:j + 2]
+                    if self._hosts[left] == self._hosts[mid] == self._hosts[right]:
+                        del self._hosts[mid]
+                        del self._vols[j]
+            self._save()
+
+    @staticmethod
+    def card_url(host: int, product_id: int) -> str:
+        vol, part = product_id // 100000, product_id // 1000
+        return (
+            f"{WB_BASKET_URL.format(host=host)}/vol{vol}/part{part}/"
+            f"{product_id}/info/ru/card.json"
+        )
+
+    async def _probe(self, host: int, product_id: int, retry: bool = False) -> Optional[WBCard]:
+        """Return the card of ``product_id`` from ``host``; ``None`` on 404.
+
+        Only a 404 means "not this host".  429/5xx, timeouts and network
+        errors raise, so that a transient failure is tried again instead.
+        """
+        url = self.card_url(host, product_id)
+        status, body, headers = await image_engine.get(url, timeout=WB_PROBE_TIMEOUT, retry=retry)
+        if status == 200:
+            return WBCard.from_response(product_id, host, body, headers)
+        if status == 404:
+            return None
+        raise HttpStatusError(status, url)
+
+    async def resolve_async(self, product_id: int | str) -> Optional[WBCard]:
+        """Find the host of ``product_id`` and return its card."""
+        import asyncio
+        product_id = int(product_id)
+        vol = product_id // 100000
+        hosts = self.candidates(vol)
+
+        # Сначала — предсказанный хост, с повторами: на тёплом кеше это единственный запрос
+        try:
+            card = await self._probe(hosts[0], product_id, retry=True)
+        except Exception as e:
+            logging.info('WB %s: basket-%02d не ответил: %s', product_id, hosts[0], e)
+            card = None
+        if card is not None:
+            await image_engine.call(self.learn, vol, hosts[0])
+            return card
+
+        remaining = iter(hosts[1:])
+        probes: dict[asyncio.Task, int] = {}
+        # Ответили ошибкой, а не 404: после перебора спросим их ещё раз, с повторами
+        uncertain: list[int] = []
+
+        def probe_next() -> None:
+            host = next(remaining, None)
+            if host is not None:
+                probes[asyncio.ensure_future(self._probe(host, product_id))] = host
+
+        for _ in range(self.workers):
+            probe_next()
+        try:
+            while probes:
+                done, _ = await asyncio.wait(probes, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    host = probes.pop(task)
+                    try:
+                        card = task.result()
+                    except Exception:
+                        uncertain.append(host)
+                        card = None
+                    if card is not None:
+                        await image_engine.call(self.learn, vol, host)
+                        return card
+                    probe_next()
+        finally:
+            for task in probes:
+                task.cancel()
+
+        results = await asyncio.gather(
+            *(self._probe(host, product_id, retry=True) for host in uncertain),
+            return_exceptions=True,
+        )
+        for host, card in zip(uncertain, results):
+            if isinstance(card, WBCard):
+                await image_engine.call(self.learn, vol, host)
+                return card
+            if isinstance(card, BaseException):
+                logging.info('WB %s: basket-%02d не ответил: %s', product_id, host, card)
+        return None
+
+    def resolve(self, product_id: int | str) -> Optional[WBCard]:
+        """Synchronous wrapper of :meth:`resolve_async`."""
+        return image_engine.run(self.resolve_async(product_id))
+
+
+basket_resolver = BasketResolver()
+
+
+# === Wildberries: скачивание изображений ===
+WB_IMAGE_TIMEOUT = 10
+
+
+class WBImageFetcher:
+    """Downloads product images through :data:`image_engine`.
+
+    Every image of a card is requested at once; the per-host semaphore of
+    the engine bounds how many are in flight, so the cards of a batch share
+    the connection budget of their basket host.  Images already on disk
+    are skipped, or revalidated with ``If-Modified-Since`` when the card
+    has changed.
+    """
+
+    async def _fetch(self, img_url: str, out_path: str, since: Optional[float]) -> Optional[str]:
+        from email.utils import formatdate
+        headers = {'If-Modified-Since': formatdate(since, usegmt=True)} if since else None
+        try:
+            hasher = content_store.hasher()
+            written = await image_engine.download(
+                img_url, out_path, timeout=WB_IMAGE_TIMEOUT, headers=headers, hasher=hasher
+            )
+            if written is not None:
+                await image_engine.call(finish_image, out_path, hasher)
+                print(f"Скачано: {out_path}")
+            return out_path
+        except Exception as e:
+            logging.error("Не удалось скачать %s: %s", img_url, e)
+            return None
+
+    @staticmethod
+    def _mtimes(paths: list[str]) -> list[Optional[float]]:
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    async def fetch_product_async(
+        self, base_url: str, count: int, folder: str, changed: bool = True
+    ) -> list[str]:
+        """Fetch ``images/big/1..count.webp`` under ``base_url`` into ``folder``.
+
+        Returns every image of the product that is on disk afterwards, as
+        :class:`CachedFiles` when nothing had to be requested.
+        """
+        import asyncio
+        paths = [os.path.join(folder, f"{i}.webp") for i in range(1, count + 1)]
+        mtimes = await image_engine.call(self._mtimes, paths)
+        if not changed and None not in mtimes:
+            return CachedFiles(paths)
+        results = await asyncio.gather(*(
+            self._fetch(f"{base_url}/images/big/{i}.webp", path, mtime)
+            for i, (path, mtime) in enumerate(zip(paths, mtimes), 1)
+            if mtime is None or changed
+        ))
+        present = {path for path, mtime in zip(paths, mtimes) if mtime is not None}
+        present.update(path for path in results if path)
+        return [path for path in paths if path in present]
+
+    def fetch_product(
+        self, base_url: str, count: int, folder: str, changed: bool = True
+    ) -> list[str]:
+        return image_engine.run(self.fetch_product_async(base_url, count, folder, changed))
+
+
+wb_image_fetcher = WBImageFetcher()
+
+
+async def load_wb_card(product_id: int) -> tuple[Optional[WBCard], bool]:
+    """Return the card of ``product_id`` and whether it changed since it was cached.
+
+    A fresh cached card costs no request, a stale one a conditional request
+    to its host; an unknown product (or one gone from its host) is looked up
+    by :data:`basket_resolver`.
+    """
+    if wb_card_cache.ttl is None:
+        await image_engine.call(wb_card_cache.configure)
+    cached = await image_engine.call(wb_card_cache.get, product_id)
+    if cached is not None and cached.fresh(wb_card_cache.ttl):
+        return cached, False
+    card = None
+    if cached is not None:
+        try:
+            status, body, headers = await image_engine.get(
+                BasketResolver.card_url(cached.host, product_id),
+                timeout=WB_PROBE_TIMEOUT, headers=cached.validators(),
+            )
+        except Exception as e:
+            logging.info('WB %s: карточка не перепроверена: %s', product_id, e)
+            status, body, headers = 0, b'', {}
+        if status == 304:
+            cached.checked = time.time()
+            card = cached
+        elif status == 200:
+            card = WBCard.from_response(product_id, cached.host, body, headers)
+    if card is None:
+        card = await basket_resolver.resolve_async(product_id)
+        if card is None:
+            return None, True
+    await image_engine.call(wb_card_cache.put, card)
+    return card, cached is None or card.data != cached.data
+
+
+async def download_wb_images_async(url: str, folder: str) -> list[str]:
+    """Скачивает все изображения товара Wildberries."""
+    try:
+        m = WB_ID_RE.search(url)
+        if not m:
+            print("Не удалось извлечь ID товара из ссылки WB.")
+            return []
+        product_id = m.group(1)
+
+        vol = int(product_id) // 100000
+        part = int(product_id) // 1000
+
+        card, changed = await load_wb_card(int(product_id))
+        if card is None:
+            print("Не удалось получить данные о товаре WB.")
+            return []
+        host_used, card_data = card.host, card.data
+
+        name = card_data.get("imt_name", f"wb_{product_id}")
+        safe_name = "".join(c for c in name if c not in "\\/:*?\"<>|")
+        product_folder = os.path.join(folder, f"{safe_name} [{product_id}]")
+        await image_engine.call(os.makedirs, product_folder, exist_ok=True)
+
+        count = card_data.get("media", {}).get("photo_count") or 0
+        if not count:
+            print("Не удалось определить количество изображений WB.")
+            return []
+
+        base_url = (
+            f"{WB_BASKET_URL.format(host=host_used)}/vol{vol}/part{part}/{product_id}"
+        )
+        saved = await wb_image_fetcher.fetch_product_async(
+            base_url, count, product_folder, changed
+        )
+        if len(saved) < count:
+            # Задача остаётся в списке; при повторе докачаются только недостающие
+            logging.warning(
+                "WB %s: скачано %d из %d изображений", product_id, len(saved), count
+            )
+            print(f"WB {product_id}: скачано {len(saved)} из {count} изображений, остальные — при следующем запуске.")
+            return PartialFiles(saved)
+        if isinstance(saved, CachedFiles):
+            print(f"WB {product_id}: карточка не менялась, все изображения уже скачаны.")
+        return saved
+    except Exception as e:
+        logging.error("Ошибка при скачивании изображений WB: %s", e)
+        print(f"Ошибка при скачивании изображений WB: {e}")
+        return []
+
+
+def download_wb_images(url: str, folder: str) -> list[str]:
+    """Скачивает изображения товара WB через :data:`image_engine`."""
+    return image_engine.run(download_wb_images_async(url, folder))
+
+
+# === Обработчики сайтов ===
+YOUTUBE_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([\w-]{11})(?![\w-])')
+WB_ID_RE = re.compile(r'/catalog/(\d+)/')
+# "/pin/123456/" и пин с названием "/pin/some-title--123456/"
+PIN_ID_RE = re.compile(r'/pin/(?:[^/?#]*--)?(\d+)(?=[/?#]|$)')
+# Метки перед ссылкой в списке: "[audio] https://..." или "[720p] https://..."
+_LIST_TAG_RE = re.compile(r'^\s*\[([\w-]+)\]\s*')
+
+
+def split_tags(line: str) -> tuple[tuple[str, ...], str]:
+    """Split ``[tag] [tag] url`` into lowercase tags and the bare URL."""
+    tags = []
+    while m := _LIST_TAG_RE.match(line):
+        tags.append(m.group(1).lower())
+        line = line[m.end():]
+    return tuple(tags), line.strip()
+
+
+def is_link_line(line: str) -> bool:
+    """Whether a list line is a URL, optionally with ``[tag]`` prefixes."""
+    return bool(URL_RE.match(split_tags(line)[1]))
+
+
+@dataclass(frozen=True)
+class SiteHandler:
+    """Describes one supported site for dispatch, scheduling and the index.
+
+    ``hosts`` are domain suffixes (``youtube.com`` also matches
+    ``www.youtube.com``), ``paths`` optionally narrows them to URL path
+    prefixes.  ``concurrency`` is the key of :data:`SITE_LIMITS` and
+    :data:`SITE_PRIORITY` the job is scheduled under.
+    """
+
+    name: str
+    hosts: tuple[str, ...]
+    download: Optional[Callable[..., list[str]]]
+    folder: str
+    message: str
+    id_re: Optional[re.Pattern] = None
+    concurrency: str = ''
+    paths: tuple[str, ...] = ()
+    # Передавать ли общий YtdlEngine пакета (download(url, folder, engine=...))
+    engine: bool = False
+    # Передавать ли метку из списка как профиль формата (download(..., profile=...))
+    formats: bool = False
+    # Свежесть решает сам обработчик (кеш карточек WB): индекс его не пропускает,
+    # только запоминает файлы
+    revalidate: bool = False
+
+    def __post_init__(self) -> None:
+        if not self.concurrency:
+            object.__setattr__(self, 'concurrency', self.name)
+
+    def matches(self, path: str) -> bool:
+        return not self.paths or path.startswith(self.paths)
+
+    def item_id(self, url: str) -> Optional[str]:
+        if self.id_re is None:
+            return None
+        m = self.id_re.search(url)
+        return f"{self.name}:{m.group(1)}" if m else None
+
+
+OTHER_HANDLER = SiteHandler('other', (), None, DOWNLOADS_FOLDER, "Сайт не поддерживается этим скриптом.")
+SITE_HANDLERS: list[SiteHandler] = []
+# Суффикс домена -> обработчики; заполняется register_handler
+_HOST_TABLE: dict[str, list[SiteHandler]] = {}
+
+
+@functools.lru_cache(maxsize=1024)
+def _handler_for(host: str, path: str) -> SiteHandler:
+    labels = host.split('.')
+    # www.youtube.com -> youtube.com -> com: одна проверка словаря на уровень
+    for i in range(len(labels) - 1):
+        for handler in _HOST_TABLE.get('.'.join(labels[i:]), ()):
+            if handler.matches(path):
+                return handler
+    return OTHER_HANDLER
+
+
+def register_handler(handler: SiteHandler) -> SiteHandler:
+    """Add ``handler`` to the dispatch table.
+
+    Handlers with ``paths`` are tried before the catch-all handler of the
+    same host, whatever the registration order.
+    """
+    SITE_HANDLERS.append(handler)
+    for host in handler.hosts:
+        entries = _HOST_TABLE.setdefault(host.lower(), [])
+        entries.append(handler)
+        entries.sort(key=lambda h: not h.paths)
+    _handler_for.cache_clear()
+    return handler
+
+
+register_handler(SiteHandler(
+    'playlist', ('youtube.com',),
+    download_playlist, PLAYLIST_FOLDER, "Это плейлист YouTube. Скачиваем всё в: {folder}",
+    paths=('/playlist',), engine=True, formats=True,
+))
+register_handler(SiteHandler(
+    'youtube', ('youtube.com', 'youtu.be'),
+    download_video, VIDEOS_FOLDER, "Это видео YouTube. Скачиваем в: {folder}",
+    id_re=YOUTUBE_ID_RE, engine=True, formats=True,
+))
+register_handler(SiteHandler(
+    'pinterest', ('pinterest.com',),
+    download_pinterest_image, PICTURES_FOLDER, "Это Pinterest ссылка. Пытаемся скачать...",
+    id_re=PIN_ID_RE,
+))
+register_handler(SiteHandler(
+    'wb', ('wildberries.ru',),
+    download_wb_images, WB_FOLDER, "Это ссылка Wildberries. Пытаемся скачать изображения...",
+    id_re=WB_ID_RE, revalidate=True,
+))
+
+
+def site_handler(url: str) -> SiteHandler:
+    """Return the registered handler for ``url`` or :data:`OTHER_HANDLER`."""
+    try:
+        parsed = urlparse(split_tags(url)[1])
+        host = (parsed.hostname or '').rstrip('.')
+    except ValueError:
+        return OTHER_HANDLER
+    return _handler_for(host, parsed.path)
+
+
+def classify_url(url: str) -> str:
+    """Return the site class of ``url`` used for scheduling."""
+    return site_handler(url).name
+
+
+def canonical_id(url: str) -> Optional[str]:
+    """Return a site-independent identity such as ``youtube:<id>`` for ``url``.
+
+    A tagged line gets the tags as a suffix (``youtube:<id>:audio``): the
+    audio-only copy is a different item than the video.
+    """
+    tags, bare = split_tags(url)
+    key = site_handler(bare).item_id(bare)
+    if key and tags:
+        key += ':' + ','.join(tags)
+    return key
+
+
+# === Индекс скачанного ===
+# Имена файлов/папок, по которым индекс восстанавливается из DOWNLOADS_FOLDER
+# "Название [id].mp4" или копия по метке "Название [id] (720p).mp4"
+_VIDEO_FILE_RE = re.compile(r'\[([\w-]{11})\](?: \((\w+)\))?\.\w+$')
+_WB_FOLDER_RE = re.compile(r'\[(\d+)\]$')
+_PIN_FILE_RE = re.compile(r'^(\d+)_')
+
+
+_TRACKING_PARAMS = frozenset({'si', 'feature', 'fbclid', 'gclid', 'yclid'})
+
+
+def canonical_key(url: str) -> str:
+    """Return one key per item: :func:`canonical_id` or a normalised URL."""
+    key = canonical_id(url)
+    if key:
+        return key
+    tags, url = split_tags(url)
+    parsed = urlparse(url)
+    host = (parsed.hostname or '').lower()
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+        if not (k.lower().startswith('utm_') or k.lower() in _TRACKING_PARAMS)
+    )
+    path = parsed.path.rstrip('/') or '/'
+    key = urlunparse(('https', host, path, '', urlencode(query), ''))
+    return ''.join(f'[{t}] ' for t in tags) + key
+
+
+class CachedFiles(list):
+    """Files of an item that needed no download (download index, fresh WB card)."""
+
+
+class PartialFiles(list):
+    """Files of an item a handler downloaded only in part.
+
+    The job fails and stays in the list, and the item is not indexed, so
+    the next run fetches what is missing.
+    """
+
+
+class DownloadIndex:
+    """Maps canonical item IDs to the files already on disk.
+
+    The database is opened lazily; when it does not exist yet it is rebuilt
+    from the names that the downloaders give to files and folders.
+    """
+
+    def __init__(self, path: str = INDEX_FILE) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            fresh = not os.path.exists(self.path)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS items ('
+                ' key TEXT PRIMARY KEY, paths TEXT NOT NULL, updated REAL NOT NULL)'
+            )
+            if fresh:
+                self._rebuild(self._db)
+        return self._db
+
+    def lookup(self, key: str) -> Optional[list[str]]:
+        """Return the files of ``key`` if they are all still present."""
+        with self._lock:
+            db = self._conn()
+            row = db.execute('SELECT paths FROM items WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return None
+            paths = json.loads(row[0])
+            if paths and all(os.path.exists(p) for p in paths):
+                return paths
+            db.execute('DELETE FROM items WHERE key = ?', (key,))
+            return None
+
+    def record(self, key: str, paths: list[str]) -> None:
+        with self._lock:
+            self._conn().execute(
+                'INSERT OR REPLACE INTO items VALUES (?, ?, ?)',
+                (key, json.dumps(sorted(paths)), time.time()),
+            )
+
+    @staticmethod
+    def scan(root: Optional[str] = None) -> dict[str, list[str]]:
+        """Collect ``{canonical_id: files}`` from the download folders."""
+        found: dict[str, list[str]] = defaultdict(list)
+        for dirpath, dirnames, filenames in os.walk(root or DOWNLOADS_FOLDER):
+            dirnames[:] = [d for d in dirnames if d != STORE_DIRNAME]
+            wb = _WB_FOLDER_RE.search(os.path.basename(dirpath))
+            for name in filenames:
+                if name.endswith(('.part', '.part.json', '.tmp', '.ytdl')):
+                    continue
+                path = os.path.join(dirpath, name)
+                if wb:
+                    found[f"wb:{wb.group(1)}"].append(path)
+                elif m := _VIDEO_FILE_RE.search(name):
+                    suffix = f":{m.group(2)}" if m.group(2) else ''
+                    found[f"youtube:{m.group(1)}{suffix}"].append(path)
+                elif m := _PIN_FILE_RE.match(name):
+                    found[f"pinterest:{m.group(1)}"].append(path)
+        return found
+
+    def _rebuild(self, db: sqlite3.Connection) -> int:
+        found = self.scan()
+        now = time.time()
+        db.execute('BEGIN')
+        db.execute('DELETE FROM items')
+        db.executemany(
+            'INSERT INTO items VALUES (?, ?, ?)',
+            ((key, json.dumps(sorted(paths)), now) for key, paths in found.items()),
+        )
+        db.execute('COMMIT')
+        logging.info('Индекс загрузок перестроен: %d записей', len(found))
+        return len(found)
+
+    def rebuild(self) -> int:
+        """Re-scan ``DOWNLOADS_FOLDER`` and replace the index contents."""
+        with self._lock:
+            return self._rebuild(self._conn())
+
+
+download_index = DownloadIndex()
+
+
+def download_url(url: str, engine: Optional[YtdlEngine] = None) -> list[str]:
+    """Определяет тип ссылки и запускает скачивание.
+
+    Returns the list of files written; an empty list means the job failed.
+    """
+    tags, bare = split_tags(url)
+    handler = site_handler(bare)
+    print(handler.message.format(folder=handler.folder))
+    if handler.download is None:
+        logging.warning('Неизвестная ссылка: %s', url)
+        return []
+    logging.info('Скачиваем (%s): %s', handler.name, url)
+    kwargs = {}
+    if handler.engine:
+        kwargs['engine'] = engine
+    profile = next((t for t in tags if is_format_tag(t)), None) if handler.formats else None
+    if profile:
+        kwargs['profile'] = profile
+    ignored = [t for t in tags if t != profile]
+    if ignored:
+        logging.warning('Метки %s не поддерживаются для %s', ', '.join(ignored), handler.name)
+    return handler.download(bare, handler.folder, **kwargs)
+
+
+def handle_url(url: str, engine: Optional[YtdlEngine] = None) -> list[str]:
+    """Skip items already in the download index, otherwise download ``url``.
+
+    Handlers with ``revalidate`` are always called and decide themselves
+    what is still fresh.
+    """
+    key = canonical_id(url)
+    if key and not site_handler(split_tags(url)[1]).revalidate:
+        cached = download_index.lookup(key)
+        if cached:
+            logging.info('Уже скачано (%s): %s', key, url)
+            print(f"Уже скачано: {url}")
+            return CachedFiles(cached)
+    files = download_url(url, engine)
+    if key and files and not isinstance(files, PartialFiles):
+        download_index.record(key, files)
+    return files
+
+
+# === Планировщик загрузок ===
+# Общее число потоков и ограничения параллельности для каждого сайта
+MAX_WORKERS = 6
+SITE_LIMITS = {
+    'playlist': 1,
+    'youtube': 2,
+    'wb': 4,
+    'pinterest': 4,
+    'other': 1,
+}
+# Меньшее значение — раньше в очереди: картинки не ждут многогигабайтные видео
+SITE_PRIORITY = {
+    'pinterest': 0,
+    'wb': 1,
+    'youtube': 2,
+    'playlist': 3,
+    'other': 4,
+}
+
+
+@dataclass(order=True)
+class DownloadJob:
+    """A single URL scheduled by :class:`DownloadScheduler`."""
+
+    priority: int
+    seq: int
+    url: str = field(compare=False)
+    site: str = field(compare=False)
+    status: str = field(default='queued', compare=False)
+    files: list[str] = field(default_factory=list, compare=False)
+    size: int = field(default=0, compare=False)
+    error: str = field(default='', compare=False)
+    started: float = field(default=0.0, compare=False)
+    finished: float = field(default=0.0, compare=False)
+    cached: bool = field(default=False, compare=False)
+    # Ключ SITE_LIMITS; по умолчанию совпадает с site
+    concurrency: str = field(default='', compare=False)
+
+    @property
+    def duration(self) -> float:
+        if not self.started:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+
+class DownloadScheduler:
+    """Bounded worker pool with per-site concurrency limits and priorities.
+
+    Jobs are taken in priority order, but a job whose site is already at its
+    limit is skipped so that one slow site never holds up the others.
+    """
+
+    def __init__(
+        self,
+        handler: Optional[Callable[[str], list[str]]] = None,
+        max_workers: int = MAX_WORKERS,
+        limits: Optional[dict] = None,
+        on_update: Optional[Callable[[DownloadJob], None]] = None,
+        stop: Optional[threading.Event] = None,
+    ) -> None:
+        self.handler = handler or handle_url
+        self.on_update = on_update
+        self.stop = stop
+        self.max_workers = max(1, max_workers)
+        self.limits = {**SITE_LIMITS, **(limits or {})}
+        self.jobs: list[DownloadJob] = []
+        self._pending: list[DownloadJob] = []
+        self._active: dict[str, int] = defaultdict(int)
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._closed = False
+        self._workers: list[threading.Thread] = []
+
+    def submit(self, url: str) -> DownloadJob:
+        handler = site_handler(url)
+        slot = handler.concurrency
+        with self._cond:
+            self._seq += 1
+            job = DownloadJob(
+                SITE_PRIORITY.get(slot, len(SITE_PRIORITY)), self._seq, url, handler.name,
+                concurrency=slot,
+            )
+            bisect.insort(self._pending, job)
+            self.jobs.append(job)
+            metrics.queue_depth = len(self._pending)
+            self._cond.notify()
+        return job
+
+    def _next_job(self) -> Optional[DownloadJob]:
+        with self._cond:
+            while True:
+                # После stop() запущенные задачи доделываются, новые не берутся
+                if self.stop is not None and self.stop.is_set():
+                    return None
+                if not self._pending:
+                    if self._closed:
+                        return None
+                    self._cond.wait(0.5)
+                    continue
+                for i, job in enumerate(self._pending):
+                    if self._active[job.concurrency] < self.limits.get(job.concurrency, 1):
+                        del self._pending[i]
+                        metrics.queue_depth = len(self._pending)
+                        self._active[job.concurrency] += 1
+                        return job
+                self._cond.wait(0.5)
+
+    def _notify(self, job: DownloadJob) -> None:
+        if self.on_update is None:
+            return
+        try:
+            self.on_update(job)
+        except Exception as e:
+            logging.error('Ошибка обработчика статуса задачи %s: %s', job.url, e)
+
+    @staticmethod
+    def _size(paths: list[str]) -> int:
+        size = 0
+        for path in paths:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                # Файл мог как раз заменяться (обработка картинок, хранилище)
+                pass
+        return size
+
+    def _run_job(self, job: DownloadJob) -> None:
+        try:
+            job.status = 'running'
+            job.started = time.monotonic()
+            metrics.job_started(job)
+            self._notify(job)
+            try:
+                job.files = self.handler(job.url) or []
+            except Exception as e:
+                logging.error('Ошибка задачи %s: %s', job.url, e)
+                job.error = str(e)
+            job.finished = time.monotonic()
+            job.cached = isinstance(job.files, CachedFiles)
+            if not job.cached:
+                job.size = self._size(job.files)
+            job.status = 'done' if job.files and not isinstance(job.files, PartialFiles) else 'failed'
+            if job.status == 'failed' and not job.error:
+                job.error = 'скачано не полностью' if job.files else 'нет скачанных файлов'
+            metrics.job_finished(job)
+            self._notify(job)
+        except Exception as e:
+            # Сбой учёта не должен стоить потока и слота: иначе wait_idle ждёт вечно
+            logging.error('Ошибка учёта задачи %s: %s', job.url, e)
+            job.status = 'failed'
+            job.error = job.error or str(e)
+        finally:
+            with self._cond:
+                self._active[job.concurrency] -= 1
+                self._cond.notify_all()
+
+    def _worker(self) -> None:
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            self._run_job(job)
+
+    def start(self) -> None:
+        """Start the workers; jobs may keep being submitted until :meth:`close`."""
+        self._workers = [
+            threading.Thread(target=self._worker, daemon=True) for _ in range(self.max_workers)
+        ]
+        for t in self._workers:
+            t.start()
+
+    def close(self) -> None:
+        """Let the workers exit once the queue is drained."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def join(self) -> list[DownloadJob]:
+        for t in self._workers:
+            t.join()
+        return self.jobs
+
+    def wait_idle(self, timeout: float) -> bool:
+        """Wait up to ``timeout`` seconds for the queue to drain; return if idle."""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: not self._pending and not any(self._active.values()), timeout
+            )
+            return not self._pending and not any(self._active.values())
+
+    def run(self) -> list[DownloadJob]:
+        """Process all submitted jobs and block until they finish."""
+        self.start()
+        self.close()
+        return self.join()
+
+
+def format_report(jobs: list[DownloadJob], elapsed: float) -> str:
+    """Build the per-job status table and the batch throughput summary."""
+    lines = []
+    for job in jobs:
+        status = 'cached' if job.cached else job.status
+        line = (
+            f"[{status:>6}] {job.site:<9} {job.duration:7.1f} с "
+            f"{job.size / 1048576:9.2f} МБ  {job.url}"
+        )
+        if job.error:
+            line += f"  ({job.error})"
+        lines.append(line)
+    done = sum(1 for j in jobs if j.status == 'done')
+    total = sum(j.size for j in jobs)
+    speed = total / elapsed / 1048576 if elapsed > 0 else 0.0
+    lines.append(
+        f"Готово {done}/{len(jobs)}, ошибок {len(jobs) - done}; "
+        f"{total / 1048576:.2f} МБ за {elapsed:.1f} с ({speed:.2f} МБ/с)"
+    )
+    for summary in (metrics.format_savings(), metrics.image_summary()):
+        if summary:
+            lines.append(summary)
+    return "\n".join(lines)
+
+
+# === Журнал задач ===
+class JobJournal:
+    """Persistent per-URL state of ``download-list.txt`` in SQLite.
+
+    Each URL is ``queued``, ``running``, ``done`` or ``failed`` (with a
+    reason).  Every state change is its own transaction, so after a crash
+    the next batch skips finished URLs and resumes the rest.
+    """
+
+    def __init__(self, path: str = JOURNAL_FILE) -> None:
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' url TEXT PRIMARY KEY,'
+            ' state TEXT NOT NULL,'
+            ' reason TEXT NOT NULL DEFAULT \'\','
+            ' attempts INTEGER NOT NULL DEFAULT 0,'
+            ' updated REAL NOT NULL)'
+        )
+
+    def sync(self, urls: list[str]) -> list[str]:
+        """Align the journal with the list and return the URLs still to do.
+
+        Rows for URLs no longer in the list are dropped, new URLs are queued
+        and ``running`` rows left over from a crash are queued again.
+        """
+        now = time.time()
+        with self._lock:
+            db = self._db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute('CREATE TEMP TABLE IF NOT EXISTS listed (url TEXT PRIMARY KEY)')
+                db.execute('DELETE FROM listed')
+                db.executemany('INSERT OR IGNORE INTO listed VALUES (?)', ((u,) for u in urls))
+                db.execute('DELETE FROM jobs WHERE url NOT IN (SELECT url FROM listed)')
+                db.executemany(
+                    "INSERT OR IGNORE INTO jobs (url, state, updated) VALUES (?, 'queued', ?)",
+                    ((u, now) for u in urls),
+                )
+                db.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'")
+                done = {row[0] for row in db.execute("SELECT url FROM jobs WHERE state = 'done'")}
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        return [u for u in urls if u not in done]
+
+    def add(self, urls: list[str]) -> list[str]:
+        """Queue ``urls`` that are not journalled yet; return those not done."""
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO jobs (url, state, updated) VALUES (?, 'queued', ?)",
+                ((u, now) for u in urls),
+            )
+            done = {
+                row[0] for row in self._db.execute("SELECT url FROM jobs WHERE state = 'done'")
+            }
+        return [u for u in urls if u not in done]
+
+    def mark(self, url: str, state: str, reason: str = '') -> None:
+        with self._lock:
+            self._db.execute(
+                'UPDATE jobs SET state = ?, reason = ?, updated = ?,'
+                ' attempts = attempts + (? = \'running\') WHERE url = ?',
+                (state, reason, time.time(), state, url),
+            )
+
+    def record(self, job: DownloadJob) -> None:
+        """``DownloadScheduler`` status hook."""
+        self.mark(job.url, job.status, job.error)
+
+    def urls_in_state(self, state: str) -> set[str]:
+        with self._lock:
+            return {row[0] for row in self._db.execute('SELECT url FROM jobs WHERE state = ?', (state,))}
+
+    def forget(self, urls: set[str]) -> None:
+        with self._lock:
+            self._db.executemany('DELETE FROM jobs WHERE url = ?', ((u,) for u in urls))
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+# Как часто во время скачивания проверяются новые строки списка, секунды
+LIST_POLL_INTERVAL = 1.0
+
+
+class ListQueue:
+    """Incremental reader of ``download-list.txt``.
+
+    Keeps a byte offset and returns only lines appended since the previous
+    call, so links added with the hotkey during a batch join the running
+    batch without re-reading the whole file.  If the file is replaced or
+    shrinks, reading restarts from the beginning.  A last line without a
+    newline counts once the file stops growing (or on the first read).
+    """
+
+    def __init__(self, path: str = DOWNLOAD_LIST) -> None:
+        self.path = path
+        self.offset = 0
+        self._ino: Optional[int] = None
+        self._size = 0
+
+    def read_new(self) -> list[str]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+        restart = st.st_ino != self._ino or st.st_size < self.offset
+        if restart:
+            self._ino, self.offset = st.st_ino, 0
+        settled = restart or st.st_size == self._size
+        self._size = st.st_size
+        if st.st_size == self.offset:
+            return []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # Строка без перевода в конце: её могут ещё дописывать, поэтому она ждёт
+        # следующего вызова, если файл растёт.  Блокнот так сохраняет последнюю строку
+        end = len(data) if settled else data.rfind(b'\n') + 1
+        self.offset += end
+        text = data[:end].decode('utf-8', errors='replace')
+        return [line.strip() for line in text.splitlines() if line.strip()]
+
+    def compact(self, done: set[str]) -> None:
+        """Atomically drop ``done`` URLs from the file, keeping every other line."""
+        link_list.rewrite(lambda line: line not in done)
+        st = os.stat(self.path)
+        self._ino, self.offset = st.st_ino, st.st_size
+        self._size = st.st_size
+
+
+def run_batch(
+    urls: list[str],
+    on_update: Optional[Callable[[DownloadJob], None]] = None,
+    stop: Optional[threading.Event] = None,
+    poll: Optional[Callable[[], list[str]]] = None,
+) -> list[DownloadJob]:
+    """Download ``urls`` through the scheduler and print the batch report.
+
+    ``poll`` is called while the batch runs and may return more URLs to add.
+    """
+    engine = YtdlEngine()
+    bandwidth.refresh(force=True)
+    ytdl_pool.configure()
+    content_store.configure()
+    image_processor.configure()
+    image_engine.configure()
+    wb_card_cache.configure()
+    max_workers, limits = bandwidth.concurrency()
+    scheduler = DownloadScheduler(
+        handler=functools.partial(handle_url, engine=engine),
+        max_workers=max_workers,
+        limits=limits,
+        on_update=on_update,
+        stop=stop,
+    )
+    for url in urls:
+        scheduler.submit(url)
+    started = time.monotonic()
+    metrics.start_batch()
+    interval = load_section('metrics', METRICS_DEFAULTS)['status_interval']
+    writing = threading.Event()
+
+    def write_status() -> None:
+        while not writing.wait(interval):
+            metrics.write_status()
+
+    threading.Thread(target=write_status, daemon=True).start()
+    scheduler.start()
+    try:
+        while not (stop is not None and stop.is_set()):
+            idle = scheduler.wait_idle(LIST_POLL_INTERVAL if poll else 3600)
+            extra = poll() if poll else []
+            for url in extra:
+                scheduler.submit(url)
+            if idle and not extra:
+                break
+    finally:
+        scheduler.close()
+        jobs = scheduler.join()
+        engine.close()
+        ytdl_pool.close()
+        image_processor.close()
+        writing.set()
+        metrics.end_batch()
+        metrics.write_status()
+    report = format_report(jobs, time.monotonic() - started)
+    logging.info('Итоги скачивания:\n%s', report)
+    print(report)
+    logging.info('HTTP по хостам:\n%s', http_client.format_stats())
+    return jobs
+
+
+def process_download_list(stop: Optional[threading.Event] = None) -> list[DownloadJob]:
+    """Download every unfinished URL from ``download-list.txt``.
+
+    Lines appended while the batch runs are picked up as they appear.  The
+    file is compacted only after the journal has committed the finished URLs.
+    """
+    queue = ListQueue()
+    urls = list(dict.fromkeys(queue.read_new()))
+    if not urls:
+        print("Список ссылок пуст.")
+        return []
+
+    journal = JobJournal()
+    try:
+        pending = journal.sync(urls)
+        if len(pending) < len(urls):
+            print(f"Пропущено уже скачанных ссылок: {len(urls) - len(pending)}")
+        seen = set(urls)
+
+        def poll() -> list[str]:
+            new = [u for u in dict.fromkeys(queue.read_new()) if u not in seen]
+            seen.update(new)
+            if new:
+                logging.info('Новые ссылки во время скачивания: %d', len(new))
+            return journal.add(new) if new else []
+
+        jobs = run_batch(pending, on_update=journal.record, stop=stop, poll=poll)
+        if stop is not None and stop.is_set():
+            print("Остановлено: незавершённые ссылки остались в списке.")
+
+        done = journal.urls_in_state('done')
+        queue.compact(done)
+        journal.forget(done)
+    finally:
+        journal.close()
+    failed = [job for job in jobs if job.status == 'failed']
+    if failed:
+        print(f"Ссылок с ошибками: {len(failed)} — они остались в списке.")
+    return jobs
+
+
+def download_all(icon: Optional['pystray.Icon'] = None) -> None:
+    """Скачивает все ссылки из файла download-list.txt в отдельном потоке."""
+    if downloading.is_set():
+        print("Скачивание уже выполняется.")
+        return
+
+    # —————— Смена иконки на dw.ico ——————
+    if icon is not None and tray_image('downloading'):
+        try:
+            icon.icon = tray_image('downloading')
+        except Exception:
+            pass
+
+    def tooltip() -> None:
+        # Подсказка значка показывает текущую суммарную скорость
+        while not tooltip_done.wait(1.0):
+            try:
+                icon.title = f"{TRAY_TITLE} — {metrics.tooltip()}"
+            except Exception:
+                return
+
+    tooltip_done = threading.Event()
+
+    def worker() -> None:
+        try:
+            if not os.path.exists(DOWNLOAD_LIST):
+                print("Файл download-list.txt не найден.")
+                return
+
+            if not process_download_list():
+                return
+            print("Скачивание завершено!")
+            if icon is not None:
+                try:
+                    icon.notify('Complete', 'Скачивание завершено')
+                except Exception:
+                    pass
+
+        finally:
+            downloading.clear()
+            tooltip_done.set()
+            # —————— Возврат иконки ico.ico ——————
+            if icon is not None and tray_image('default'):
+                try:
+                    icon.icon = tray_image('default')
+                except Exception:
+                    pass
+            if icon is not None:
+                try:
+                    icon.title = TRAY_TITLE
+                except Exception:
+                    pass
+
+    downloading.set()
+    threading.Thread(target=worker, daemon=True).start()
+    if icon is not None:
+        threading.Thread(target=tooltip, daemon=True).start()
+
+
+
+# === Список ссылок ===
+class LinkList:
+    """In-memory mirror of ``download-list.txt`` for O(1) duplicate checks.
+
+    The set of :func:`canonical_key` values is refreshed from the file only
+    when its ``stat`` changes: appended bytes are read incrementally and any
+    other change (the batch compacting the list, manual edits) triggers one
+    full reload.
+
+    Appends go through one writer thread with group commit: links queued
+    while it writes and fsyncs one group are written together as the next.
+    """
+
+    def __init__(self, path: str = DOWNLOAD_LIST) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._pending: list[tuple[str, Future]] = []
+        self._last: Optional[Future] = None
+        self._writer: Optional[threading.Thread] = None
+        self._keys: set[str] = set()
+        self._stamp: Optional[tuple[int, int]] = None
+        self._size = 0
+        self._newline = True
+
+    def _read(self, offset: int) -> None:
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        if not data:
+            return
+        self._newline = data.endswith(b'\n')
+        for line in data.decode('utf-8', errors='replace').splitlines():
+            if line.strip():
+                self._keys.add(canonical_key(line))
+
+    def _refresh(self) -> None:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._keys.clear()
+            self._stamp, self._size, self._newline = None, 0, True
+            return
+        stamp = (st.st_ino, st.st_mtime_ns)
+        if stamp == self._stamp and st.st_size == self._size:
+            return
+        if self._stamp and stamp[0] == self._stamp[0] and st.st_size > self._size:
+            # Частый случай: в файл только дописали строки
+            self._read(self._size)
+        else:
+            self._keys.clear()
+            self._newline = True
+            self._read(0)
+        self._stamp, self._size = stamp, st.st_size
+
+    def load(self) -> None:
+        """Read the file now so that the first :meth:`append` does not have to."""
+        with self._lock:
+            self._refresh()
+
+    def _commit(self, urls: list[str]) -> list[bool]:
+        """Append the new ones of ``urls`` with a single write and fsync."""
+        with self._lock:
+            self._refresh()
+            keys, results = set(), []
+            for url in urls:
+                key = canonical_key(url)
+                results.append(key not in self._keys and key not in keys)
+                keys.add(key)
+            lines = [url for url, new in zip(urls, results) if new]
+            if not lines:
+                return results
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(('' if self._newline else '\n') + ''.join(url + '\n' for url in lines))
+                f.flush()
+                os.fsync(f.fileno())
+            self._keys.update(canonical_key(url) for url in lines)
+            self._newline = True
+            st = os.stat(self.path)
+            self._stamp, self._size = (st.st_ino, st.st_mtime_ns), st.st_size
+            return results
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                group, self._pending = self._pending, []
+            try:
+                results = self._commit([url for url, _ in group])
+            except Exception as e:
+                for _, future in group:
+                    future.set_exception(e)
+                continue
+            for (_, future), added in zip(group, results):
+                future.set_result(added)
+
+    def append(self, url: str) -> Future:
+        """Queue ``url`` for the writer thread and return at once.
+
+        The future turns ``True`` once the line is fsynced, ``False`` if an
+        equivalent link is already listed, or holds the ``OSError``.
+        """
+        future: Future = Future()
+        with self._cond:
+            self._pending.append((url, future))
+            self._last = future
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name='link-writer', daemon=True)
+                self._writer.start()
+            self._cond.notify()
+        return future
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Wait until every link queued so far is written."""
+        with self._cond:
+            last = self._last
+        if last is not None:
+            futures_wait([last], timeout)
+
+    def rewrite(self, keep: Callable[[str], bool]) -> None:
+        """Atomically rewrite the file with the lines for which ``keep`` is true.
+
+        Runs under the same lock as :meth:`add`, so a link appended by the
+        hotkey can never be lost between reading and replacing the file.
+        """
+        with self._lock:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    lines = [line.strip() for line in f if line.strip()]
+            except FileNotFoundError:
+                lines = []
+            atomic_write_text(self.path, ''.join(line + '\n' for line in lines if keep(line)))
+            self._refresh()
+
+
+link_list = LinkList()
+
+
+# Сколько ждать, пока после Ctrl+C изменится буфер обмена, и как часто проверять
+CLIPBOARD_TIMEOUT = 1.0
+CLIPBOARD_POLL = 0.01
+# Копирование по горячей клавише: нажатия обрабатываются по очереди в одном потоке
+clipboard_worker = ThreadPoolExecutor(1, thread_name_prefix='clipboard')
+
+
+def copy_selection(timeout: float = CLIPBOARD_TIMEOUT) -> str:
+    """Send Ctrl+C and return the clipboard text as soon as it has changed.
+
+    On Windows the clipboard sequence number is polled, elsewhere the text
+    itself (less often, it costs a subprocess).  After ``timeout`` the
+    clipboard is read as it is: the same text may have been copied again.
+    """
+    import keyboard
+
+    sequence = win32clipboard is not None and hasattr(win32clipboard, 'GetClipboardSequenceNumber')
+
+    def stamp():
+        return win32clipboard.GetClipboardSequenceNumber() if sequence else read_clipboard()
+
+    before = stamp()
+    keyboard.press_and_release('ctrl+c')
+    deadline = time.monotonic() + timeout
+    interval = CLIPBOARD_POLL if sequence else CLIPBOARD_POLL * 5
+    while True:
+        now = stamp()
+        if now != before or time.monotonic() >= deadline:
+            break
+        time.sleep(interval)
+    return read_clipboard() if sequence else now
+
+
+def _report_added(url: str, future: Future) -> None:
+    try:
+        added = future.result()
+    except OSError as e:
+        logging.error('Failed to save link %s: %s', url, e)
+        print("Не удалось добавить ссылку в список.")
+        return
+    if added:
+        logging.info('Link added: %s', url)
+        print(f"Добавлено в список: {url}")
+    else:
+        logging.info('Дубликат ссылки: %s', url)
+        print('Ссылка уже присутствует в списке.')
+
+
+def add_link_from_clipboard(icon: Optional['pystray.Icon'] = None) -> None:
+    """Copy the current selection and append it to ``download-list.txt``.
+
+    Runs in :data:`clipboard_worker`; the hotkey callback only submits it.
+    The line is queued to :data:`link_list` without waiting for the write.
+    """
+
+    logging.info('Hotkey triggered: copying selection')
+    if icon is not None:
+        flash_tray_icon(icon, tray_image('active'))
+
+    try:
+        url = copy_selection().strip()
+    except Exception as e:
+        logging.error("Clipboard read error: %s", e)
+        url = ''
+
+    if not url:
+        logging.info('Clipboard capture failed or empty')
+        print("Не удалось скопировать ссылку. Возможно, она не выделена.")
+        return
+
+    if not is_link_line(url):
+        logging.info('Clipboard text not a valid URL: %s', url)
+        print("Скопированный текст не похож на ссылку.")
+        return
+
+    link_list.append(url).add_done_callback(functools.partial(_report_added, url))
+
+
+def warm_up() -> None:
+    """Load what the hotkeys and the first download need, off the startup path."""
+    started = time.monotonic()
+    for state in ICON_FILES:
+        tray_image(state)
+    link_list.load()
+    http_client.session
+    logging.info('Фоновая подготовка завершена за %.2f с', time.monotonic() - started)
+
+
+def run_tray() -> None:
+    """Запускает горячие клавиши и значок в трее."""
+    import keyboard
+    import pystray
+
+    ensure_single_instance()
+    config = load_config()
+    ensure_directories()
+    start_metrics_server()
+    if not os.path.exists(DOWNLOAD_LIST):
+        open(DOWNLOAD_LIST, 'a', encoding='utf-8').close()
+
+    add_hotkey = config.get('add_hotkey', DEFAULT_CONFIG['add_hotkey'])
+    download_hotkey = config.get('download_hotkey', DEFAULT_CONFIG['download_hotkey'])
+
+    # Горячая клавиша только ставит задачу: копирование и запись идут в своих потоках
+    def on_add(icon: 'pystray.Icon'):
+        clipboard_worker.submit(add_link_from_clipboard, icon)
+
+    # Меняем горячую клавишу
+    def change_hotkey(icon, item):
+        icon.notify('Настройка', 'Нажмите новое сочетание и Enter')
+        hotkey_manager.unregister_all()
+        hotkey_manager.stop_listener()
+        try:
+            new_key = keyboard.read_hotkey()
+            if new_key:
+                config['add_hotkey'] = new_key
+                save_config(config)
+                icon.notify('Готово', f'Новая клавиша: {new_key}')
+        except Exception as e:
+            logging.error('Ошибка смены горячей клавиши: %s', e)
+        finally:
+            hotkey_manager.start_listener()
+            # Восстанавливаем привязки
+            hotkey_manager.register(config['add_hotkey'], lambda: on_add(icon))
+            hotkey_manager.register(config['download_hotkey'], lambda: download_all(icon))
+
+    # Меню «Скачать»
+    def on_download(icon, item):
+        download_all(icon)
+
+    # Выход
+    def on_exit(icon, item):
+        icon.stop()
+
+    # Открыть список загрузок
+    def open_list(icon, item):
+        try:
+            if sys.platform.startswith('win'):
+                os.startfile(DOWNLOAD_LIST)
+            else:
+                subprocess.Popen(['xdg-open', DOWNLOAD_LIST])
+        except Exception as e:
+            logging.error('Не удалось открыть файл со списком: %s', e)
+
+    # Открыть папку загрузок
+    def open_folder(icon, item):
+        try:
+            if sys.platform.startswith('win'):
+                os.startfile(DOWNLOADS_FOLDER)
+            else:
+                subprocess.Popen(['xdg-open', DOWNLOADS_FOLDER])
+        except Exception as e:
+            logging.error('Не удалось открыть папку загрузок: %s', e)
+
+    # Информация
+    def show_info(icon, item):
+        try:
+            if os.path.exists(INFO_FILE):
+                if sys.platform.startswith('win'):
+                    os.startfile(INFO_FILE)
+                else:
+                    subprocess.Popen(['xdg-open', INFO_FILE])
+            else:
+                icon.notify('Информация', 'Файл info.txt не найден')
+        except Exception as e:
+            logging.error('Не удалось открыть info.txt: %s', e)
+
+    # Составляем меню
+    menu = pystray.Menu(
+        pystray.MenuItem('Скачать', on_download),
+        pystray.MenuItem('Список загрузок', open_list),
+        pystray.MenuItem('Открыть папку для загрузки', open_folder),
+        pystray.MenuItem('Горячие клавиши', change_hotkey),
+        pystray.MenuItem('Инфо', show_info),
+        pystray.MenuItem('Выход', on_exit),
+    )
+
+    # Иконка в трее
+    tray_icon = pystray.Icon('YTDownloader', tray_image('default'), TRAY_TITLE, menu)
+
+    # Привязка горячих клавиш
+    hotkey_manager.register(add_hotkey, lambda: on_add(tray_icon))
+    hotkey_manager.register(download_hotkey, lambda: download_all(tray_icon))
+    # Остальные значки, список ссылок и HTTP-сессия — в фоне, не задерживая значок
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+    print(f"Значок размещён в трее. Горячие клавиши {add_hotkey} и {download_hotkey} активны.")
     tray_icon.run()
     hotkey_manager.unregister_all()
+    clipboard_worker.shutdown()
+    link_list.flush()
+    print('Скрипт завершён.')
+
+# === Headless-режим ===
+DAEMON_INTERVAL = 5.0
+# Файлы *.txt, положенные в эту папку, добавляются в download-list.txt.
+# Пишите их под другим именем и переименовывайте, когда файл готов.
+SPOOL_DIR = os.path.join(SYSTEM_DIR, 'spool')
+
+
+def install_signal_handlers(stop: threading.Event) -> None:
+    """Set ``stop`` on SIGINT/SIGTERM (and SIGBREAK on Windows).
+
+    A second signal also cancels the running YouTube jobs.
+    """
+
+    def handler(signum, frame) -> None:
+        if stop.is_set():
+            # Повторный сигнал — не ждать текущие видео
+            print("Прерываем текущие загрузки YouTube...")
+            ytdl_pool.cancel_all()
+            return
+        logging.info('Получен сигнал %s, завершаемся.', signum)
+        print("Завершаем работу после текущих загрузок... (ещё раз — прервать видео)")
+        stop.set()
+
+    for name in ('SIGINT', 'SIGTERM', 'SIGBREAK'):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), handler)
+
+
+def collect_urls(sources: list[str]) -> list[str]:
+    """Expand command-line arguments (links or list files) into URLs."""
+    urls: list[str] = []
+    for source in sources:
+        if is_link_line(source):
+            urls.append(source)
+        elif os.path.isfile(source):
+            with open(source, 'r', encoding='utf-8') as f:
+                urls.extend(line.strip() for line in f if is_link_line(line))
+        else:
+            logging.warning('Не ссылка и не файл: %s', source)
+            print(f"Пропускаем: {source} — не ссылка и не файл.")
+    return list(dict.fromkeys(urls))
+
+
+def drain_spool(spool: str) -> int:
+    """Move links from ``spool/*.txt`` into the download list; return how many."""
+    added = 0
+    try:
+        names = sorted(n for n in os.listdir(spool) if n.endswith('.txt'))
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        path = os.path.join(spool, name)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                queued = [link_list.append(line.strip()) for line in f if is_link_line(line)]
+            added += sum(future.result() for future in queued)
+            os.remove(path)
+        except OSError as e:
+            logging.error('Не удалось обработать %s: %s', path, e)
+    return added
+
+
+def run_download(sources: list[str]) -> int:
+    """``download`` command: fetch the given links once, without the tray."""
+    ensure_directories()
+    urls = collect_urls(sources)
+    if not urls:
+        print("Нет ссылок для скачивания.")
+        return 1
+    stop = threading.Event()
+    install_signal_handlers(stop)
+    jobs = run_batch(urls, stop=stop)
+    return 0 if all(job.status == 'done' for job in jobs) else 1
+
+
+def run_daemon(interval: float = DAEMON_INTERVAL, spool: str = SPOOL_DIR) -> int:
+    """``daemon`` command: keep processing ``download-list.txt`` until a signal."""
+    ensure_single_instance()
+    ensure_directories()
+    os.makedirs(spool, exist_ok=True)
+    if not os.path.exists(DOWNLOAD_LIST):
+        open(DOWNLOAD_LIST, 'a', encoding='utf-8').close()
+    start_metrics_server()
+    stop = threading.Event()
+    install_signal_handlers(stop)
+    logging.info('Daemon started: %s, spool %s', DOWNLOAD_LIST, spool)
+    print(f"Следим за {DOWNLOAD_LIST} и {spool}. Ctrl+C — выход.")
+    # Список обрабатывается, только когда он изменился: ссылки с ошибками
+    # остаются в нём и не должны скачиваться заново каждые ``interval`` секунд.
+    handled: Optional[tuple[int, int]] = None
+    while not stop.is_set():
+        if drain_spool(spool):
+            logging.info('Ссылки из spool добавлены в список')
+        try:
+            st = os.stat(DOWNLOAD_LIST)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            st, stamp = None, None
+        if st is not None and st.st_size > 0 and stamp != handled:
+            try:
+                process_download_list(stop)
+            except Exception as e:
+                logging.error('Ошибка пакетного скачивания: %s', e)
+            try:
+                st = os.stat(DOWNLOAD_LIST)
+                handled = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                handled = None
+        stop.wait(interval)
     print('Скрипт завершён.')
+    return 0
+
+
+def run_store_maintenance(collect: bool) -> int:
+    """``store`` command: report on the content store and optionally collect orphans."""
+    content_store.configure()
+    if not os.path.isdir(content_store.root):
+        print(f"Хранилища нет: {content_store.root} (включается в [store] enabled = true)")
+        return 0
+    st = content_store.maintain(collect)
+    mb = 1048576
+    print(
+        f"Хранилище {content_store.root}: файлов {st['files']}, {st['size'] / mb:.1f} МБ, "
+        f"ссылок {st['links']}, сэкономлено {st['saved'] / mb:.1f} МБ"
+    )
+    if st['orphans']:
+        action = 'удалено' if collect else 'запустите с --gc, чтобы удалить'
+        print(f"Без ссылок: {st['orphans']} файлов, {st['orphan_size'] / mb:.1f} МБ — {action}")
+    if st['broken']:
+        print(f"Битых символических ссылок в {DOWNLOADS_FOLDER}: {st['broken']}")
+    logging.info('Обслуживание хранилища: %s', st)
+    return 0
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    """Без аргументов — трей; ``download`` / ``daemon`` / ``reindex`` / ``store`` — без интерфейса."""
+    parser = argparse.ArgumentParser(description='Загрузчик YouTube, Pinterest и Wildberries.')
+    sub = parser.add_subparsers(dest='command')
+    dl = sub.add_parser('download', help='скачать ссылки или файлы со ссылками и выйти')
+    dl.add_argument('sources', nargs='+', help='ссылки или пути к спискам')
+    daemon = sub.add_parser('daemon', help='следить за download-list.txt и папкой spool')
+    daemon.add_argument('--interval', type=float, default=DAEMON_INTERVAL, help='секунды между проверками')
+    daemon.add_argument('--spool', default=SPOOL_DIR, help='папка с файлами *.txt для очереди')
+    sub.add_parser('reindex', help='перестроить индекс скачанного по папке Downloads')
+    store = sub.add_parser('store', help='отчёт по хранилищу [store] и удаление сирот')
+    store.add_argument('--gc', action='store_true', help='удалить файлы, на которые нет ссылок')
+    args = parser.parse_args(argv)
+
+    if args.command == 'download':
+        return run_download(args.sources)
+    if args.command == 'daemon':
+        return run_daemon(args.interval, args.spool)
+    if args.command == 'reindex':
+        print(f"Записей в индексе: {download_index.rebuild()}")
+        return 0
+    if args.command == 'store':
+        return run_store_maintenance(args.gc)
+    run_tray()
+    return 0
+
 
 if __name__ == '__main__':
-    main()
+    import multiprocessing
+    multiprocessing.freeze_support()
+    sys.exit(main())
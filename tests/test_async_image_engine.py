@@ -0,0 +1,39 @@
+import hashlib
+import threading
+
+import pytest
+
+import main_windows_strict as app
+from test_segmented_download import BODY, SIZE, RangeHandler
+
+pytest.importorskip('aiohttp')
+
+
+class CountingHandler(RangeHandler):
+    ranges = []
+
+    def do_GET(self):
+        type(self).ranges.append(self.headers.get('Range'))
+        super().do_GET()
+
+
+@pytest.fixture
+def server():
+    from http.server import ThreadingHTTPServer
+    CountingHandler.ranges = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), CountingHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}/big.jpg'
+    httpd.shutdown()
+
+
+def test_large_body_goes_through_segmented_download(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'http_client', app.HttpClient(retries=0, host_rate=0))
+    engine = app.AsyncImageEngine()
+    path = tmp_path / 'big.jpg'
+    hasher = app.StreamHash()
+
+    assert engine.run(engine.download(server, str(path), hasher=hasher)) == SIZE
+    assert path.read_bytes() == BODY
+    assert hasher.hexdigest() == hashlib.sha256(BODY).hexdigest()
+    assert sum(r is not None for r in CountingHandler.ranges) >= 2
@@ -0,0 +1,55 @@
+import datetime
+
+import pytest
+
+import main_windows_strict as app
+
+
+@pytest.mark.parametrize('text, rate', [
+    ('2M', 2 * 1024 ** 2),
+    ('500k', 500 * 1024),
+    ('1.5mb/s', 1.5 * 1024 ** 2),
+    ('1048576', 1048576),
+    ('', 0),
+])
+def test_parse_rate(text, rate):
+    assert app.parse_rate(text) == rate
+
+
+@pytest.mark.parametrize('spec, hour, inside', [
+    ('09:00-18:00', 9, True),
+    ('09:00-18:00', 18, False),
+    ('22:00-07:00', 23, True),
+    ('22:00-07:00', 3, True),
+    ('22:00-07:00', 12, False),
+])
+def test_in_hours(spec, hour, inside):
+    assert app._in_hours(spec, datetime.datetime(2024, 1, 1, hour)) is inside
+
+
+@pytest.mark.parametrize('spec, day, inside', [
+    ('mon-fri', 1, True),    # понедельник
+    ('mon-fri', 6, False),   # суббота
+    ('sat,sun', 7, True),
+    ('fri-mon', 1, True),
+    ('fri-mon', 3, False),
+    ('', 3, True),
+])
+def test_in_days(spec, day, inside):
+    assert app._in_days(spec, datetime.datetime(2024, 1, day)) is inside
+
+
+def test_token_bucket_debt(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(app.time, 'monotonic', lambda: now[0])
+    bucket = app.TokenBucket(1000)
+    assert bucket.reserve(1000) == 0
+    assert bucket.reserve(500) == pytest.approx(0.5)
+    now[0] += 0.5
+    assert bucket.reserve(500) == pytest.approx(0.5)
+    now[0] += 10
+    assert bucket.reserve(1000) == 0
+
+
+def test_token_bucket_without_rate():
+    assert app.TokenBucket(0).reserve(10 ** 9) == 0
@@ -0,0 +1,29 @@
+import pytest
+
+import main_windows_strict as app
+
+
+@pytest.mark.parametrize('url, key', [
+    ('https://www.youtube.com/watch?v=dQw4w9WgXcQ&si=abc', 'youtube:dQw4w9WgXcQ'),
+    ('https://youtu.be/dQw4w9WgXcQ?t=42', 'youtube:dQw4w9WgXcQ'),
+    ('https://m.youtube.com/shorts/dQw4w9WgXcQ', 'youtube:dQw4w9WgXcQ'),
+    ('[Audio] https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'youtube:dQw4w9WgXcQ:audio'),
+    ('https://www.wildberries.ru/catalog/12345/detail.aspx?size=1', 'wb:12345'),
+    ('https://ru.pinterest.com/pin/987654/', 'pinterest:987654'),
+])
+def test_canonical_id(url, key):
+    assert app.canonical_id(url) == key
+
+
+def test_canonical_id_of_unknown_url():
+    assert app.canonical_id('https://example.com/a') is None
+
+
+@pytest.mark.parametrize('url, key', [
+    ('https://WWW.Example.com/a/b/?utm_source=x&b=2&a=1#frag', 'https://example.com/a/b?a=1&b=2'),
+    ('http://m.example.com/?fbclid=1', 'https://example.com/'),
+    ('[720p] https://example.com/v', '[720p] https://example.com/v'),
+    ('https://youtu.be/dQw4w9WgXcQ', 'youtube:dQw4w9WgXcQ'),
+])
+def test_canonical_key(url, key):
+    assert app.canonical_key(url) == key
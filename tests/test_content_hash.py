@@ -0,0 +1,49 @@
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import main_windows_strict as app
+
+BODY = bytes(range(256)) * 64
+
+
+class BrokenOnceHandler(BaseHTTPRequestHandler):
+    """Drops the connection halfway through the first response body."""
+
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        type(self).requests += 1
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        if type(self).requests == 1:
+            self.wfile.write(BODY[:len(BODY) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(BODY)
+
+
+@pytest.fixture
+def server():
+    BrokenOnceHandler.requests = 0
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), BrokenOnceHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}/photo.jpg'
+    httpd.shutdown()
+
+
+def test_digest_covers_only_the_saved_file(server, tmp_path):
+    path = tmp_path / 'photo.jpg'
+    hasher = app.StreamHash()
+    client = app.HttpClient(retries=1, backoff=0, host_rate=0)
+    assert client.download(server, str(path), hasher=hasher) == len(BODY)
+    assert BrokenOnceHandler.requests == 2
+    assert path.read_bytes() == BODY
+    assert hasher.hexdigest() == hashlib.sha256(BODY).hexdigest()
@@ -0,0 +1,17 @@
+import main_windows_strict as app
+
+
+def test_scan_keeps_tagged_copies_apart(tmp_path):
+    for name in (
+        'Song [dQw4w9WgXcQ].mp4',
+        'Song [dQw4w9WgXcQ] (audio).m4a',
+        'Song [dQw4w9WgXcQ] (720p).mp4',
+        'Song [dQw4w9WgXcQ] (720p).mp4.part',
+    ):
+        (tmp_path / name).write_bytes(b'')
+
+    found = app.DownloadIndex.scan(str(tmp_path))
+    assert sorted(found) == [
+        'youtube:dQw4w9WgXcQ', 'youtube:dQw4w9WgXcQ:720p', 'youtube:dQw4w9WgXcQ:audio',
+    ]
+    assert found['youtube:dQw4w9WgXcQ:audio'] == [str(tmp_path / 'Song [dQw4w9WgXcQ] (audio).m4a')]
@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import main_windows_strict as app
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """``/<status>/<failures>``: answer ``status`` that many times, then 200."""
+
+    hits = Counter()
+    retry_after = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        _, status, failures = self.path.split('/')
+        type(self).hits[self.path] += 1
+        failing = type(self).hits[self.path] <= int(failures)
+        body = b'' if failing else b'ok'
+        self.send_response(int(status) if failing else 200)
+        if failing and self.retry_after:
+            self.send_header('Retry-After', self.retry_after)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    FlakyHandler.hits = Counter()
+    FlakyHandler.retry_after = None
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+@pytest.fixture
+def client():
+    return app.HttpClient(retries=2, backoff=0.01, host_rate=0)
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_transient_status_is_retried(server, client, status):
+    resp = client.get(f'{server}/{status}/2')
+    assert resp.status_code == 200
+    assert resp.content == b'ok'
+    assert FlakyHandler.hits[f'/{status}/2'] == 3
+    stats = client.stats()[server.split('//')[1]]
+    assert stats['retries'] == 2
+
+
+def test_retries_run_out_with_last_response(server, client):
+    assert client.get(f'{server}/503/5').status_code == 503
+    assert FlakyHandler.hits['/503/5'] == 3
+
+
+def test_not_found_is_not_retried(server, client):
+    assert client.get(f'{server}/404/5').status_code == 404
+    assert FlakyHandler.hits['/404/5'] == 1
+
+
+def test_retry_after_is_capped(server, client, monkeypatch):
+    monkeypatch.setattr(app, 'HTTP_BACKOFF_MAX', 0.05)
+    FlakyHandler.retry_after = '3600'
+    started = time.monotonic()
+    assert client.get(f'{server}/429/1').status_code == 200
+    assert time.monotonic() - started < 1
+
+
+def test_backoff_grows_up_to_the_cap(client, monkeypatch):
+    monkeypatch.setattr(app, 'HTTP_BACKOFF_MAX', 0.1)
+    delays = [client._delay(attempt, None) for attempt in range(6)]
+    assert 0.01 <= delays[0] <= 0.02
+    assert 0.04 <= delays[2] <= 0.05
+    assert delays[-1] == 0.1
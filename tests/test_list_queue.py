@@ -0,0 +1,30 @@
+import main_windows_strict as app
+
+
+def test_last_line_without_newline_is_read(tmp_path):
+    path = tmp_path / 'download-list.txt'
+    path.write_bytes(b'https://www.youtube.com/watch?v=aaaaaaaaaaa')
+    queue = app.ListQueue(str(path))
+    assert queue.read_new() == ['https://www.youtube.com/watch?v=aaaaaaaaaaa']
+    assert queue.read_new() == []
+
+
+def test_growing_tail_waits_until_file_settles(tmp_path):
+    path = tmp_path / 'download-list.txt'
+    path.write_bytes(b'https://a.example/1\n')
+    queue = app.ListQueue(str(path))
+    assert queue.read_new() == ['https://a.example/1']
+    with open(path, 'ab') as f:
+        f.write(b'https://a.example/2\nhttps://a.exa')
+    assert queue.read_new() == ['https://a.example/2']
+    assert queue.read_new() == ['https://a.exa']
+
+
+def test_append_after_unterminated_line(tmp_path):
+    path = tmp_path / 'download-list.txt'
+    path.write_bytes(b'https://a.example/1')
+    queue = app.ListQueue(str(path))
+    assert queue.read_new() == ['https://a.example/1']
+    with open(path, 'ab') as f:
+        f.write(b'\nhttps://a.example/2\n')
+    assert queue.read_new() == ['https://a.example/2']
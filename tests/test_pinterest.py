@@ -0,0 +1,33 @@
+import pytest
+
+import main_windows_strict as app
+
+
+@pytest.mark.parametrize('url, pin', [
+    ('https://www.pinterest.com/pin/123456/', '123456'),
+    ('https://ru.pinterest.com/pin/123456', '123456'),
+    ('https://www.pinterest.com/pin/cozy-reading-nook--987654321/', '987654321'),
+    ('https://www.pinterest.com/pin/2024-ideas--555/?utm_source=x', '555'),
+    ('https://www.pinterest.com/pin/AaBbCc123/', None),
+    ('https://www.pinterest.com/alice/cats/', None),
+])
+def test_pin_id(url, pin):
+    m = app.PIN_ID_RE.search(url)
+    assert (m.group(1) if m else None) == pin
+
+
+@pytest.mark.parametrize('url, board', [
+    ('https://www.pinterest.com/alice/cats/', ('alice', 'cats')),
+    ('https://ru.pinterest.com/alice/cats', ('alice', 'cats')),
+    ('https://www.pinterest.com/alice/', None),
+    ('https://www.pinterest.com/alice/_saved/', None),
+    ('https://www.pinterest.com/search/pins/?q=cats', None),
+    ('https://www.pinterest.com/ideas/cats/123/', None),
+    ('https://www.pinterest.com/pin/cozy--123/', None),
+])
+def test_pinterest_board(url, board):
+    assert app.pinterest_board(url) == board
+
+
+def test_slug_pin_is_indexed_by_its_id():
+    assert app.canonical_id('https://www.pinterest.com/pin/cozy-nook--987654/') == 'pinterest:987654'
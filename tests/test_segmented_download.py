@@ -0,0 +1,62 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import main_windows_strict as app
+
+SIZE = app.SEGMENT_MIN_SIZE + 12345
+BODY = bytes(range(256)) * (SIZE // 256) + b'x' * (SIZE % 256)
+ETAG = '"v2"'
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves BODY with ETag v2; If-Range with another validator gets the whole file."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        rng = self.headers.get('Range')
+        if rng and self.headers.get('If-Range', ETAG) == ETAG:
+            start, end = (int(x) for x in rng.split('=')[1].split('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{SIZE}')
+            body = BODY[start:end + 1]
+        else:
+            self.send_response(200)
+            body = BODY
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', ETAG)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}/file.bin'
+    httpd.shutdown()
+
+
+def test_resume_of_changed_file_starts_over(server, tmp_path):
+    path = tmp_path / 'file.bin'
+    part = tmp_path / 'file.bin.part'
+    part.write_bytes(b'\0' * SIZE)
+    step = -(-SIZE // 4)
+    state = {
+        'url': server,
+        'size': SIZE,
+        'validator': '"v1"',
+        'segments': [[s, min(s + step, SIZE) - 1, 1000] for s in range(0, SIZE, step)],
+    }
+    (tmp_path / 'file.bin.part.json').write_text(json.dumps(state))
+
+    client = app.HttpClient(retries=0, host_rate=0)
+    assert client.download(server, str(path)) == SIZE
+    assert path.read_bytes() == BODY
+    assert not part.exists()
+    assert not (tmp_path / 'file.bin.part.json').exists()
@@ -0,0 +1,24 @@
+import main_windows_strict as app
+
+
+def test_partials_of_killed_download_are_removed(tmp_path):
+    keep = [
+        'Clip [dQw4w9WgXcQ].mp4',
+        'Clip [dQw4w9WgXcQ] (audio).m4a',
+        'Other [aaaaaaaaaaa].mp4.part',
+    ]
+    drop = [
+        'Clip [dQw4w9WgXcQ].f137.mp4',
+        'Clip [dQw4w9WgXcQ].f251-drc.webm.part',
+        'Clip [dQw4w9WgXcQ].f137.mp4.part-Frag7',
+        'Clip [dQw4w9WgXcQ].mp4.ytdl',
+        'Clip [dQw4w9WgXcQ].temp.mp4',
+    ]
+    for name in keep + drop:
+        (tmp_path / name).write_bytes(b'')
+
+    app._remove_ytdl_partials({
+        str(tmp_path / 'Clip [dQw4w9WgXcQ].f137.mp4'),
+        str(tmp_path / 'Clip [dQw4w9WgXcQ].f251-drc.webm'),
+    })
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(keep)